@@ -4,34 +4,70 @@ import boto3
 import base64
 import os
 import logging
+import threading
 from urllib.parse import quote
 from dotenv import load_dotenv
 from botocore.client import Config
 
+from circuit_breaker import guarded_call, get_timeout
+from pdf_optimizer import optimize_pdf
+from run_metrics import metrics
+
 load_dotenv()
 
 AWS_S3_BUCKET = os.getenv("AWS_S3_BUCKET")
 AWS_ACCESS_KEY_ID = os.getenv("AWS_ACCESS_KEY_ID")
 AWS_SECRET_ACCESS_KEY = os.getenv("AWS_SECRET_ACCESS_KEY")
+# Only set to use another S3 compatible endpoint, e.g. the moto server of the benchmarks
+AWS_S3_ENDPOINT_URL = os.getenv("AWS_S3_ENDPOINT_URL")
 
 logger = logging.getLogger(F'LinkedInAssignDueDateUpdate.{__name__}')
 
 # AWS_SESSION_TOKEN = os.getenv("AWS_SESSION_TOKEN")
 
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
 def get_s3_client():
-    """Create a low-level service client by name using the default session.
+    """Low-level S3 client shared by every upload. boto3 clients are thread-safe once created,
+    so the stages of a run share one client and its connection pool; only creating it is locked.
 
     Returns:
         (class): Service client instance
     """
+    global _s3_client
+    with _s3_client_lock:
+        if _s3_client is None:
+            _s3_client = _create_s3_client()
+        return _s3_client
+
+def _create_s3_client():
     s3_client = boto3.client(
         "s3",
         aws_access_key_id=AWS_ACCESS_KEY_ID,
         aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
-        config=Config(signature_version='s3v4')
+        endpoint_url=AWS_S3_ENDPOINT_URL,
+        config=Config(signature_version='s3v4',
+                      s3={'addressing_style': 'path'} if AWS_S3_ENDPOINT_URL else None,
+                      connect_timeout=min(5, get_timeout('s3')),
+                      read_timeout=get_timeout('s3'),
+                      retries={'max_attempts': 2})
     )
     return s3_client
 
+def cert_url(name):
+    """The url a certificate has in the bucket, known before it is uploaded
+
+    Args:
+        name (str): name of the certificate
+
+    Returns:
+        url (str): url to the pdf of the certificate
+    """
+    if AWS_S3_ENDPOINT_URL:
+        return f'{AWS_S3_ENDPOINT_URL.rstrip("/")}/{AWS_S3_BUCKET}/{quote(name)}.pdf'
+    return f'https://{AWS_S3_BUCKET}.s3.amazonaws.com/{quote(name)}.pdf'
+
 def transfer_cert_to_aws(cert_base64, name):
     """Adds an object to the bucket
 
@@ -42,25 +78,52 @@ def transfer_cert_to_aws(cert_base64, name):
     Returns:
         url (str): url to the pdf of the certificate
     """
+    return upload_pdf(optimize_pdf(base64.b64decode(cert_base64)), name)
+
+def upload_pdf(body, name):
+    """Adds the bytes of a pdf to the bucket
+
+    Args:
+        body (bytes): the pdf
+        name (str): name of the certificate
+
+    Returns:
+        url (str): url to the pdf of the certificate, None when the upload failed
+    """
     s3_client = get_s3_client()
 
-    response = s3_client.put_object(
+    metrics.incr('api_calls')
+    response = guarded_call('s3',
+        s3_client.put_object,
         Bucket=AWS_S3_BUCKET,
         Key=f"{name}.pdf",
-        Body=base64.b64decode(cert_base64),
+        Body=body,
         ACL='public-read',
         ContentType='application/pdf'
     )
     try: 
         status = response.get("ResponseMetadata", {}).get("HTTPStatusCode")
         if status == 200:
-            url = f'https://{AWS_S3_BUCKET}.s3.amazonaws.com/{quote(name)}.pdf'
+            url = cert_url(name)
             logger.info(f"Successful S3 put_object response. Status - {status}") 
             return url
         else:
             logger.info(f"Unsuccessful S3 put_object response. Status - {status}")
+            metrics.incr('errors')
             return None
     except Exception as e:
         logger.error(e, exc_info=True)
         pass
-    
+
+def uploaded_size(name):
+    """Size in bytes of a certificate in the bucket, used to verify an upload
+
+    Args:
+        name (str): name of the certificate
+
+    Returns:
+        size (int): ContentLength of the object
+    """
+    metrics.incr('api_calls')
+    response = guarded_call('s3', get_s3_client().head_object, Bucket=AWS_S3_BUCKET, Key=f"{name}.pdf")
+    return response.get('ContentLength')
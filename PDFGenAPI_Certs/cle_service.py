@@ -0,0 +1,207 @@
+"""
+Module to render CLE certificates on demand. Most CLE certificates are never opened, so with
+CLE_MODE=on_demand in the .env file the run only stores what is needed to render the certificate
+and points cle_certificate_url at this service (CLE_SERVICE_URL). The first time the url is opened
+the certificate is rendered, uploaded to S3 and the visitor is redirected to it; later visits are
+redirected to the uploaded certificate straight away. Every url holds a random token instead of
+the (sequential) cert id, so the certificates of other students cannot be found by counting.
+
+Usage:
+    python cle_service.py [--host 127.0.0.1] [--port 8081]
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import re
+import secrets
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from dotenv import load_dotenv
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from ledger import SYNCED, UPLOADED, format_cert_id
+from models import CertIdHistory, CleCertificate, SQLITE_DB, create_tables
+
+load_dotenv()
+
+logger = logging.getLogger(F'LinkedInAssignDueDateUpdate.{__name__}')
+
+CLE_ON_DEMAND = os.getenv('CLE_MODE', 'render').lower() == 'on_demand'
+CLE_SERVICE_URL = os.getenv('CLE_SERVICE_URL', 'http://127.0.0.1:8081')
+
+CLE_PATH = re.compile(r'^/cle/([A-Za-z0-9_-]{32})\.pdf$')
+
+
+def new_token():
+    return secrets.token_urlsafe(24) # 32 characters
+
+
+def cle_url(token):
+    return f'{CLE_SERVICE_URL.rstrip("/")}/cle/{token}.pdf'
+
+
+def register_cle_cert(session, entry, template_id, body, name):
+    """Store what is needed to render a CLE certificate later and return the url it is served at
+
+    Args:
+        session: SQLAlchemy session bound to the local database
+        entry (CertIdHistory): ledger entry of the record
+        template_id (int): PDFGeneratorAPI template of the CLE certificate
+        body (dict): data to put on the template
+        name (str): name of the certificate
+
+    Returns:
+        url (str): url of the certificate on this service
+    """
+    existing = session.query(CleCertificate.token).filter_by(cert_id=entry.cert_id).first()
+    # A record registered again keeps its token, so a url already on Hubspot keeps working
+    token = existing.token if existing and existing.token else new_token()
+    session.merge(CleCertificate(cert_id=entry.cert_id, hs_instance_id=entry.hs_instance_id, token=token,
+                                 template_id=template_id, name=name, body=json.dumps(body, default=str)))
+    session.commit()
+    return cle_url(token)
+
+
+def assign_missing_tokens(session):
+    """Give a token to the CLE certificates registered before urls had one. Their new url is put in
+    the ledger and the record is pushed to Hubspot again by the reconcile of the next run; the old
+    url (with the cert id) is no longer served.
+
+    Returns:
+        (int): number of certificates that got a token
+    """
+    missing = session.query(CleCertificate).filter(CleCertificate.token.is_(None)).all()
+    for cle in missing:
+        cle.token = new_token()
+        entry = session.query(CertIdHistory).filter_by(cert_id=cle.cert_id).first()
+        if entry is not None:
+            entry.cle_certificate_url = cle_url(cle.token)
+            if entry.stage == SYNCED:
+                entry.stage = UPLOADED
+            entry.synced_at = None # Hubspot has the old url
+            entry.updated_at = datetime.datetime.utcnow()
+    session.commit()
+    return len(missing)
+
+
+class CleRenderer:
+    def __init__(self, engine):
+        """
+        Class to look up, render and remember the S3 url of on-demand CLE certificates. A
+        certificate is only rendered once, even when it is opened several times at once.
+
+        Args:
+            engine: SQLAlchemy engine of the local database
+        """
+        self.session = scoped_session(sessionmaker(bind=engine))
+        self._urls = {} # token -> S3 url of the certificates rendered so far
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def _cert_lock(self, token):
+        with self._lock:
+            return self._locks.setdefault(token, threading.Lock())
+
+    def url(self, token):
+        """S3 url of a CLE certificate, rendering and uploading it on first access
+
+        Args:
+            token (str): token in the url of the certificate
+
+        Returns:
+            url (str): S3 url, None when there is no CLE certificate with this token
+        """
+        if token in self._urls:
+            return self._urls[token]
+        with self._cert_lock(token):
+            try:
+                cle = self.session.query(CleCertificate).filter_by(token=token).first()
+                if cle is None:
+                    return None
+                if not cle.url:
+                    cle.url = self._render(cle)
+                    cle.rendered_at = datetime.datetime.utcnow()
+                    self.session.commit()
+                self._urls[token] = cle.url
+                return cle.url
+            finally:
+                self.session.remove()
+
+    def _render(self, cle):
+        # Imported here, the runner imports this module to register certificates
+        from aws_bucket import transfer_cert_to_aws
+        from pdfgenapi_linkedin_urls import PdfGenAPILinkedIn
+
+        cert_base64, name = PdfGenAPILinkedIn.create_cert(cle.template_id, json.loads(cle.body), cle.name)
+        url = transfer_cert_to_aws(cert_base64, name)
+        if url is None:
+            raise RuntimeError(f'Upload of "{name}" to S3 failed.')
+        logger.info(f'Rendered CLE certificate {format_cert_id(cle.cert_id)} on first access.')
+        return url
+
+
+def make_handler(renderer):
+    """Request handler class redirecting every CLE certificate url to its S3 url"""
+
+    class CleHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            match = CLE_PATH.match(self.path.split('?')[0])
+            if not match:
+                self.send_error(404)
+                return
+            try:
+                url = renderer.url(match.group(1))
+            except Exception as e:
+                logger.error(e, exc_info=True)
+                self.send_error(502, 'The certificate could not be rendered, please try again later.')
+                return
+            if url is None:
+                self.send_error(404)
+                return
+            self.send_response(302)
+            self.send_header('Location', url)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    return CleHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Render CLE certificates the first time they are opened.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    args = parser.parse_args()
+
+    from logger import get_logger
+    get_logger('LinkedInAssignDueDateUpdate')
+
+    create_tables()
+    engine = create_engine(SQLITE_DB)
+    session = sessionmaker(bind=engine)()
+    try:
+        assigned = assign_missing_tokens(session)
+    finally:
+        session.close()
+    if assigned:
+        logger.info(f'Gave {assigned} CLE certificate(s) registered before urls had tokens a new url.')
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(CleRenderer(engine)))
+    logger.info(f'Serving CLE certificates on http://{args.host}:{args.port}/cle/')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
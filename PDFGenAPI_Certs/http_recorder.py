@@ -0,0 +1,403 @@
+"""
+Module to record every outgoing HTTP request of a run (Hubspot, PDFGeneratorAPI, Pandadoc and S3
+all go through urllib3) along with its response and timing, and to replay a recording without
+calling any provider. A slow production run can then be recorded once and profiled, or compared
+against an optimization, offline and as often as needed.
+
+Secrets (authorization and signature headers, tokens in urls) are removed and personal data
+(names, emails, state bar numbers) is replaced with pseudonyms before a recording is saved. The
+same value always gets the same pseudonym within a recording, so the urls the replayed run builds
+from the replayed Hubspot records match the recorded ones. Certificates are replaced with filler
+of the same size.
+
+Usage:
+    python run.py --record recording.json.gz
+    CERT_DB_URL=sqlite:////tmp/replay.db python run.py --replay recording.json.gz [--replay-speed 0]
+"""
+
+import base64
+import binascii
+import datetime
+import gzip
+import hashlib
+import json
+import logging
+import re
+import secrets
+import threading
+import time
+import zlib
+
+from collections import defaultdict, deque
+from urllib.parse import parse_qsl, quote, quote_plus, urlencode, urlsplit, urlunsplit
+
+from urllib3.connectionpool import HTTPConnectionPool
+from urllib3.response import HTTPResponse
+
+logger = logging.getLogger(F'LinkedInAssignDueDateUpdate.{__name__}')
+
+# Headers and url parameters holding secrets, dropped from the recording
+SECRET_HEADERS = {'authorization', 'cookie', 'set-cookie', 'x-amz-security-token', 'x-amz-content-sha256',
+                  'x-hubspot-signature', 'x-hubspot-signature-v3', 'x-api-key'}
+SECRET_PARAMS = {'hapikey', 'access_token', 'token', 'api_key', 'x-amz-signature', 'x-amz-credential',
+                 'x-amz-security-token', 'signature', 'awsaccesskeyid'}
+# JSON fields holding personal data on their own. Fields that combine them (e.g. the name of a
+# certificate) are covered by replacing these values wherever they show up.
+PII_FIELDS = {'firstname', 'lastname', 'email', 'recipient',
+              'cle_state_bar_number__and_state__if_not_specified_above_'}
+MIN_PII_LENGTH = 3 # Shorter values are left alone, they would match all over the place
+REDACTED = '***'
+# Dates and epoch milliseconds in request bodies depend on the day of the run, so they are left out
+# when a replayed request is matched with a recorded one
+TIMESTAMP = re.compile(r'\d{4}-\d{2}-\d{2}(?:[T ]\d{2}:\d{2}(?::\d{2}(?:\.\d+)?)?(?:Z|[+-]\d{2}:?\d{2})?)?|\b1\d{12}\b')
+
+
+def _header_dict(headers):
+    return {name: value for name, value in (headers or {}).items()}
+
+
+def _decode_body(raw, headers):
+    """Body as the client sees it, and the headers without the encoding. None when the body is
+    encoded in a way that cannot be undone here."""
+    encoding = next((value for name, value in headers.items() if name.lower() == 'content-encoding'), '').lower()
+    headers = {name: value for name, value in headers.items()
+               if name.lower() not in ('content-encoding', 'transfer-encoding', 'content-length')}
+    try:
+        if encoding in ('', 'identity'):
+            body = raw
+        elif encoding in ('gzip', 'x-gzip'):
+            body = gzip.decompress(raw)
+        elif encoding == 'deflate':
+            body = zlib.decompress(raw)
+        else:
+            return None, headers
+    except (OSError, zlib.error):
+        return None, headers
+    headers['Content-Length'] = str(len(body))
+    return body, headers
+
+
+class HttpRecorder:
+    def __init__(self):
+        """Records every request sent through urllib3 while installed"""
+        self.exchanges = []
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        self._original = None
+
+    def install(self):
+        self._original = HTTPConnectionPool.urlopen
+        recorder = self
+
+        def urlopen(pool, method, url, body=None, headers=None, **kwargs):
+            return recorder._record(pool, method, url, body, headers, **kwargs)
+
+        HTTPConnectionPool.urlopen = urlopen
+        logger.info('Recording every HTTP request of the run.')
+
+    def uninstall(self):
+        if self._original:
+            HTTPConnectionPool.urlopen = self._original
+            self._original = None
+
+    def _record(self, pool, method, url, body, headers, **kwargs):
+        preload_content = kwargs.pop('preload_content', True)
+        decode_content = kwargs.pop('decode_content', True)
+        started = time.perf_counter()
+        response = self._original(pool, method, url, body=body, headers=headers,
+                                  preload_content=False, decode_content=False, **kwargs)
+        raw = response.read(decode_content=False)
+        elapsed = time.perf_counter() - started
+        response.release_conn()
+
+        full_url = url if url.startswith(('http://', 'https://')) else f'{pool.scheme}://{pool.host}:{pool.port}{url}'
+        response_headers = _header_dict(response.headers)
+        stored_body, stored_headers = _decode_body(raw, response_headers)
+        with self._lock:
+            self.exchanges.append({
+                'method': method,
+                'url': full_url,
+                'request_headers': _header_dict(headers),
+                'request_body': body if isinstance(body, (bytes, str)) else None,
+                'status': response.status,
+                'reason': response.reason,
+                'response_headers': stored_headers,
+                'response_body': stored_body,
+                'started': started - self._start,
+                'elapsed': elapsed,
+            })
+        # Hand the caller the bytes that were read, exactly as they came in
+        return HTTPResponse(body=_BytesBody(raw), headers=response.headers, status=response.status,
+                            reason=response.reason, preload_content=preload_content,
+                            decode_content=decode_content, request_method=method)
+
+    def save(self, path):
+        """Scrub the recording and save it, gzipped when the path ends in .gz
+
+        Returns:
+            (int): number of requests saved
+        """
+        with self._lock:
+            exchanges = list(self.exchanges)
+        recording = {'version': 1,
+                     'recorded_at': datetime.datetime.utcnow().isoformat(),
+                     'exchanges': Scrubber(exchanges).scrub()}
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'wt') as f:
+            json.dump(recording, f)
+        logger.info(f'Saved {len(exchanges)} recorded HTTP request(s) to {path}.')
+        return len(exchanges)
+
+
+class _BytesBody:
+    """Minimal file object for HTTPResponse, which reads its body from a file object"""
+
+    def __init__(self, data):
+        self._data = memoryview(data)
+        self._pos = 0
+        self.closed = False
+
+    def read(self, amt=None):
+        end = len(self._data) if amt is None or amt < 0 else min(len(self._data), self._pos + amt)
+        chunk = bytes(self._data[self._pos:end])
+        self._pos = end
+        return chunk
+
+    def read1(self, amt=None):
+        return self.read(amt)
+
+    def readinto(self, buffer):
+        chunk = self.read(len(buffer))
+        buffer[:len(chunk)] = chunk
+        return len(chunk)
+
+    def close(self):
+        self.closed = True
+
+
+class Scrubber:
+    def __init__(self, exchanges):
+        """
+        Removes secrets and replaces personal data in recorded exchanges
+
+        Args:
+            exchanges (list): exchanges as recorded by HttpRecorder
+        """
+        self.exchanges = exchanges
+        self._salt = secrets.token_hex(16) # New for every recording, pseudonyms cannot be looked up
+        self.pseudonyms = {}
+        self._ordered = []
+
+    def pseudonym(self, value):
+        return f'pii-{hashlib.sha256((self._salt + value).encode()).hexdigest()[:10]}'
+
+    def _collect(self, obj):
+        """Find the personal data in a JSON document"""
+        if isinstance(obj, dict):
+            for name, value in obj.items():
+                if name in PII_FIELDS and isinstance(value, str) and len(value.strip()) >= MIN_PII_LENGTH:
+                    self.pseudonyms.setdefault(value, self.pseudonym(value))
+                else:
+                    self._collect(value)
+        elif isinstance(obj, list):
+            for value in obj:
+                self._collect(value)
+
+    def _replace(self, text):
+        for value in self._ordered:
+            pseudonym = self.pseudonyms[value]
+            for form in {value, quote(value), quote_plus(value), quote(value, safe='')}:
+                text = text.replace(form, pseudonym)
+        return text
+
+    def _url(self, url):
+        parts = urlsplit(url)
+        query = urlencode([(name, REDACTED if name.lower() in SECRET_PARAMS else value)
+                           for name, value in parse_qsl(parts.query, keep_blank_values=True)])
+        # Leave the host alone, a short value could match part of it
+        return urlunsplit((parts.scheme, parts.netloc, self._replace(parts.path), self._replace(query), ''))
+
+    def _headers(self, headers):
+        return {name: REDACTED if name.lower() in SECRET_HEADERS or name.lower().startswith('x-amz-meta')
+                else self._replace(value) for name, value in headers.items()}
+
+    def _body(self, body, headers):
+        """Stored form of a body: text, or base64 for binary bodies. Certificates become filler."""
+        if body is None:
+            return None
+        content_type = next((value for name, value in headers.items() if name.lower() == 'content-type'), '')
+        if isinstance(body, bytes) and ('pdf' in content_type or body.startswith(b'%PDF')):
+            return {'filler': len(body)}
+        if isinstance(body, bytes):
+            try:
+                body = body.decode('utf-8')
+            except UnicodeDecodeError:
+                return {'filler': len(body)}
+        try:
+            document = json.loads(body)
+        except ValueError:
+            return {'text': self._replace(body)}
+        return {'text': self._replace(json.dumps(_replace_documents(document)))}
+
+    def scrub(self):
+        for exchange in self.exchanges:
+            for body in (exchange['request_body'], exchange['response_body']):
+                try:
+                    self._collect(json.loads(body))
+                except (TypeError, ValueError):
+                    continue
+        # Longest first, so an email is replaced before the name in it
+        self._ordered = sorted(self.pseudonyms, key=len, reverse=True)
+        scrubbed = []
+        for exchange in self.exchanges:
+            scrubbed.append({
+                'method': exchange['method'],
+                'url': self._url(exchange['url']),
+                'request_headers': self._headers(exchange['request_headers']),
+                'request_body': self._body(exchange['request_body'], exchange['request_headers']),
+                'status': exchange['status'],
+                'reason': exchange['reason'],
+                'response_headers': self._headers(exchange['response_headers']),
+                'response_body': self._body(exchange['response_body'], exchange['response_headers']),
+                'started': exchange['started'],
+                'elapsed': exchange['elapsed'],
+            })
+        return scrubbed
+
+
+def _replace_documents(obj):
+    """Replace base64 documents (e.g. the PDFGeneratorAPI response) with filler of the same size"""
+    if isinstance(obj, dict):
+        return {name: _replace_documents(value) for name, value in obj.items()}
+    if isinstance(obj, list):
+        return [_replace_documents(value) for value in obj]
+    if isinstance(obj, str) and len(obj) > 256 and re.fullmatch(r'[A-Za-z0-9+/=\s]+', obj):
+        try:
+            return base64.b64encode(_filler(len(base64.b64decode(obj)))).decode()
+        except binascii.Error:
+            # Looks like base64 but is not, e.g. a long id or token
+            return obj
+    return obj
+
+
+def _filler(size):
+    """Bytes standing in for a certificate of `size` bytes"""
+    head = b'%PDF-1.4\n%recorded certificate\n'
+    return (head + b'0' * max(0, size - len(head)))[:size]
+
+
+def _path_shape(url):
+    """Url with the ids taken out, to match a request whose ids differ from the recording"""
+    parts = urlsplit(url)
+    path = re.sub(r'/[^/]*\d[^/]*', '/{id}', parts.path)
+    return f'{parts.netloc}{path}'
+
+
+def _body_key(stored):
+    """Hash of a scrubbed request body with its dates and timestamps taken out"""
+    if not stored:
+        return None
+    if 'filler' in stored:
+        text = f'filler:{stored["filler"]}'
+    else:
+        text = TIMESTAMP.sub('{timestamp}', stored['text'])
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class HttpReplayer:
+    def __init__(self, path, speed=1.0):
+        """
+        Serves the responses of a recording instead of calling the providers. Requests are matched
+        on their method, url and body (scrubbed, with dates and timestamps left out), in the order
+        they were recorded, then on their method and url alone, then on their method and the shape
+        of their url (ids left out).
+
+        Args:
+            path (str): recording saved by HttpRecorder
+            speed (float, optional): factor applied to the recorded response times, 1 for the
+                recorded timings, 0 to answer straight away. Defaults to 1.
+        """
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt') as f:
+            self.exchanges = json.load(f)['exchanges']
+        self.speed = speed
+        self._by_body = defaultdict(deque)
+        self._by_url = defaultdict(deque)
+        self._by_shape = defaultdict(deque)
+        for exchange in self.exchanges:
+            self._by_body[(exchange['method'], exchange['url'], _body_key(exchange['request_body']))].append(exchange)
+            self._by_url[(exchange['method'], exchange['url'])].append(exchange)
+            self._by_shape[(exchange['method'], _path_shape(exchange['url']))].append(exchange)
+        self._used = set()
+        # Replayed bodies carry the pseudonyms of the replayed responses already, so scrubbing
+        # them only removes the certificates, like in the recording
+        self._scrubber = Scrubber([])
+        self._lock = threading.Lock()
+        self._original = None
+        self.served = self.missed = self.inexact = 0
+
+    def install(self):
+        self._original = HTTPConnectionPool.urlopen
+        replayer = self
+
+        def urlopen(pool, method, url, body=None, headers=None, **kwargs):
+            return replayer._replay(pool, method, url, body, headers, **kwargs)
+
+        HTTPConnectionPool.urlopen = urlopen
+        logger.info(f'Replaying {len(self.exchanges)} recorded HTTP request(s) at {self.speed}x the recorded time.')
+
+    def uninstall(self):
+        if self._original:
+            HTTPConnectionPool.urlopen = self._original
+            self._original = None
+        logger.info(f'Replay served {self.served} request(s), {self.inexact} of them with a different body '
+                    f'or url than recorded, {self.missed} had no recording.')
+
+    def _take(self, queue):
+        while queue:
+            exchange = queue.popleft()
+            if id(exchange) not in self._used:
+                self._used.add(id(exchange))
+                return exchange
+        return None
+
+    def _replay(self, pool, method, url, body=None, headers=None, **kwargs):
+        full_url = url if url.startswith(('http://', 'https://')) else f'{pool.scheme}://{pool.host}:{pool.port}{url}'
+        # Secrets were redacted from the recorded urls
+        parts = urlsplit(full_url)
+        lookup_url = urlunsplit(parts._replace(query=urlencode(
+            [(name, REDACTED if name.lower() in SECRET_PARAMS else value)
+             for name, value in parse_qsl(parts.query, keep_blank_values=True)]), fragment=''))
+        body_key = _body_key(self._scrubber._body(body if isinstance(body, (bytes, str)) else None,
+                                                  _header_dict(headers)))
+        with self._lock:
+            exchange = self._take(self._by_body[(method, lookup_url, body_key)])
+            if exchange is None:
+                exchange = self._take(self._by_url[(method, lookup_url)]) or \
+                    self._take(self._by_shape[(method, _path_shape(lookup_url))])
+                if exchange is not None:
+                    self.inexact += 1
+            if exchange is None:
+                self.missed += 1
+            else:
+                self.served += 1
+        if exchange is None:
+            logger.warning(f'No recorded response for {method} {lookup_url}, answering 599.')
+            status, reason, headers, body = 599, 'Not Recorded', {'Content-Length': '0'}, b''
+        else:
+            if self.speed:
+                time.sleep(exchange['elapsed'] * self.speed)
+            status, reason, headers = exchange['status'], exchange['reason'], exchange['response_headers']
+            body = _stored_bytes(exchange['response_body'])
+            headers = dict(headers, **{'Content-Length': str(len(body))})
+        return HTTPResponse(body=_BytesBody(body), headers=headers, status=status, reason=reason,
+                            preload_content=kwargs.get('preload_content', True),
+                            decode_content=kwargs.get('decode_content', True), request_method=method)
+
+
+def _stored_bytes(stored):
+    if not stored:
+        return b''
+    if 'filler' in stored:
+        return _filler(stored['filler'])
+    return stored['text'].encode('utf-8')
@@ -0,0 +1,115 @@
+"""
+Module to sign short-lived JWTs for PDFGeneratorAPI instead of using one long-lived PDFGENAPI_JWT.
+With PDFGENAPI_KEY, PDFGENAPI_WORKSPACE and PDFGENAPI_SECRET in the .env file, a token valid for
+PDFGENAPI_JWT_TTL seconds is signed with JWT_APIGEN/jwt_apigen.generate_jwt and put on the
+Configuration the API clients use. A background thread signs the next token PDFGENAPI_JWT_REFRESH
+seconds before the current one expires, so renders never wait for a token and a long run never
+fails on an expired one.
+"""
+
+import logging
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+
+from JWT_APIGEN.jwt_apigen import generate_jwt
+
+load_dotenv()
+
+logger = logging.getLogger(F'LinkedInAssignDueDateUpdate.{__name__}')
+
+PDFGENAPI_KEY = os.getenv('PDFGENAPI_KEY')
+PDFGENAPI_WORKSPACE = os.getenv('PDFGENAPI_WORKSPACE')
+PDFGENAPI_SECRET = os.getenv('PDFGENAPI_SECRET')
+PDFGENAPI_JWT_TTL = int(os.getenv('PDFGENAPI_JWT_TTL', 300)) # Seconds a token is valid
+PDFGENAPI_JWT_REFRESH = int(os.getenv('PDFGENAPI_JWT_REFRESH', 60)) # Seconds before expiry to sign the next one
+RETRY_INTERVAL = 5 # Seconds between attempts when signing a token failed
+
+
+class JwtProvider:
+    def __init__(self, key, workspace, secret, ttl=PDFGENAPI_JWT_TTL, refresh=PDFGENAPI_JWT_REFRESH):
+        """
+        Signs PDFGeneratorAPI tokens and keeps the attached Configuration on a valid one
+
+        Args:
+            key (str): API key, the issuer of the token
+            workspace (str): workspace identifier, the subject of the token
+            secret (str): API secret the token is signed with
+            ttl (int, optional): seconds a token is valid. Defaults to PDFGENAPI_JWT_TTL.
+            refresh (int, optional): seconds before expiry to sign the next token. Defaults to
+                PDFGENAPI_JWT_REFRESH.
+        """
+        self.key = key
+        self.workspace = workspace
+        self.secret = secret
+        self.ttl = ttl
+        self.refresh = min(refresh, ttl // 2) # A token is used for at least half of its life
+        self.configuration = None
+        self.expires_at = 0
+        self._token = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._refresher = None
+
+    @classmethod
+    def from_env(cls):
+        """Provider for the keys in the .env file, None when they are not all set"""
+        if not (PDFGENAPI_KEY and PDFGENAPI_WORKSPACE and PDFGENAPI_SECRET):
+            return None
+        return cls(PDFGENAPI_KEY, PDFGENAPI_WORKSPACE, PDFGENAPI_SECRET)
+
+    def _sign(self):
+        """Sign a new token and put it on the attached configuration"""
+        expires_at = int(time.time()) + self.ttl
+        token = generate_jwt(self.key, self.workspace, expires_at, self.secret)
+        if isinstance(token, bytes): # PyJWT 1.x returns bytes
+            token = token.decode()
+        self._token, self.expires_at = token, expires_at
+        if self.configuration is not None:
+            # The client reads access_token on every request, so the next request uses it
+            self.configuration.access_token = token
+        logger.debug(f'Signed a PDFGeneratorAPI token valid until {time.strftime("%H:%M:%S", time.gmtime(expires_at))} UTC.')
+        return token
+
+    def token(self):
+        """Current token, signed on the spot only when the background thread fell behind
+
+        Returns:
+            token (str): JWT for the Bearer authorization
+        """
+        if self._token and time.time() < self.expires_at - RETRY_INTERVAL:
+            return self._token
+        with self._lock:
+            if self._token and time.time() < self.expires_at - RETRY_INTERVAL:
+                return self._token
+            return self._sign()
+
+    def attach(self, configuration):
+        """Put a token on the configuration and keep it fresh from a background thread
+
+        Args:
+            configuration (pdf_generator_api_client.Configuration): configuration of the API clients
+        """
+        self.configuration = configuration
+        configuration.access_token = self.token()
+        if self._refresher is None:
+            self._refresher = threading.Thread(target=self._refresh, name='pdfgenapi-jwt', daemon=True)
+            self._refresher.start()
+
+    def _refresh(self):
+        wait = max(0, self.expires_at - self.refresh - time.time())
+        while not self._stop.wait(wait):
+            try:
+                with self._lock:
+                    self._sign()
+                wait = max(0, self.expires_at - self.refresh - time.time())
+            except Exception as e:
+                # The current token is still valid for a while, try again shortly
+                logger.error(e, exc_info=True)
+                wait = RETRY_INTERVAL
+
+    def stop(self):
+        """Stop refreshing the token"""
+        self._stop.set()
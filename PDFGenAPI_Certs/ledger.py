@@ -0,0 +1,121 @@
+"""
+Module to keep a ledger of every certificate in the cert_id_history table: its cert id, the urls
+and LinkedIn badge produced for it, and how far it got. A record that failed part way through
+picks up where it left off, and artifacts that were produced but never made it to Hubspot are
+pushed again without being rendered again.
+"""
+
+import datetime
+import logging
+
+from models import CertIdHistory
+
+logger = logging.getLogger(F'LinkedInAssignDueDateUpdate.{__name__}')
+
+# Stages of a certificate in the ledger
+ISSUED = 'issued' # cert id created, artifacts may be missing
+SPOOLED = 'spooled' # every artifact produced, some still waiting in the write-behind upload queue
+UPLOADED = 'uploaded' # every artifact produced and uploaded, not yet confirmed on Hubspot
+SYNCED = 'synced' # pushed to Hubspot
+# Hubspot gets the urls of a spooled certificate before it is uploaded. synced_at records that, so
+# the entry goes straight from SPOOLED to SYNCED once uploaded and is not pushed a second time.
+
+
+def format_cert_id(cert_id):
+    """Fill in leading 0s so that the number is 10 digits total, in nnn-nnnnn-nn format"""
+    cert_id = str(cert_id).zfill(10)
+    return f'{cert_id[:3]}-{cert_id[3:8]}-{cert_id[8:]}'
+
+
+def get_or_create_entry(session, hs_instance_id, issued_on, course_name=None):
+    """Get the ledger entry of a Hubspot record, creating it (and so its cert id) when needed
+
+    Args:
+        session: SQLAlchemy session bound to the local database
+        hs_instance_id (int): Hubspot id of the record
+        issued_on (date): issue date of a new certificate
+        course_name (str, optional): course of the certificate. Defaults to None.
+
+    Returns:
+        entry (CertIdHistory): entry of the record
+    """
+    entry = session.query(CertIdHistory).filter_by(hs_instance_id=hs_instance_id).first()
+    if entry is None:
+        entry = CertIdHistory(hs_instance_id=hs_instance_id, stage=ISSUED, issued_on=issued_on,
+                              course_name=course_name, updated_at=datetime.datetime.utcnow())
+        session.add(entry)
+        session.commit()
+    elif entry.issued_on is None or (course_name and entry.course_name is None):
+        # Entries from before the ledger only have a cert id, older ones have no course
+        entry.issued_on = entry.issued_on or issued_on
+        entry.course_name = entry.course_name or course_name
+        session.commit()
+    return entry
+
+
+def update_entry(session, entry, **fields):
+    """Store new fields of an entry straight away so they survive a later failure"""
+    for name, value in fields.items():
+        setattr(entry, name, value)
+    entry.updated_at = datetime.datetime.utcnow()
+    session.commit()
+
+
+def hs_properties(entry):
+    """Hubspot properties holding the artifacts of an entry
+
+    Args:
+        entry (CertIdHistory): entry with every artifact produced
+
+    Returns:
+        properties (dict): certificate urls, cert id and LinkedIn badge url
+    """
+    properties = {
+        'linkedin_certificate_url': entry.linkedin_certificate_url,
+        'unique_certificate_id': format_cert_id(entry.cert_id),
+        'linkedin_badge': entry.linkedin_badge
+    }
+    if entry.cle_certificate_url:
+        properties['cle_certificate_url'] = entry.cle_certificate_url
+    return properties
+
+
+def pending_sync(session):
+    """Entries whose artifacts were all produced but were never confirmed on Hubspot"""
+    return session.query(CertIdHistory) \
+        .filter(CertIdHistory.stage == UPLOADED, CertIdHistory.synced_at.is_(None)) \
+        .all()
+
+
+def mark_uploaded(session, hs_instance_id):
+    """Mark the entry of a record whose spooled certificates were all uploaded and verified. It is
+    synced when Hubspot already got its urls, otherwise it is left for the reconcile."""
+    now = datetime.datetime.utcnow()
+    spooled = session.query(CertIdHistory) \
+        .filter(CertIdHistory.hs_instance_id == int(hs_instance_id), CertIdHistory.stage == SPOOLED)
+    # Uploaded first: an entry that Hubspot gets in between is then synced by mark_synced
+    spooled.filter(CertIdHistory.synced_at.is_(None)) \
+        .update({'stage': UPLOADED, 'updated_at': now}, synchronize_session=False)
+    spooled.filter(CertIdHistory.synced_at.isnot(None)) \
+        .update({'stage': SYNCED, 'updated_at': now}, synchronize_session=False)
+    session.commit()
+
+
+def mark_synced(session, hs_instance_ids):
+    """Mark the entries of records that were updated on Hubspot. Entries whose certificates are
+    still spooled only get their synced_at, they are synced once uploaded (see mark_uploaded).
+
+    Args:
+        session: SQLAlchemy session bound to the local database
+        hs_instance_ids (list): Hubspot ids of the updated records
+    """
+    if not hs_instance_ids:
+        return
+    now = datetime.datetime.utcnow()
+    entries = session.query(CertIdHistory) \
+        .filter(CertIdHistory.hs_instance_id.in_([int(hs_id) for hs_id in hs_instance_ids]))
+    entries.filter(CertIdHistory.stage.in_([SPOOLED, UPLOADED, SYNCED])) \
+        .update({'synced_at': now, 'updated_at': now}, synchronize_session=False)
+    entries.filter(CertIdHistory.stage == UPLOADED) \
+        .update({'stage': SYNCED}, synchronize_session=False)
+    session.commit()
@@ -1,17 +1,22 @@
 """
 Module to create a SQLite schema using SQLAlchemy to hold in cert_ids and match them up with 
-Hubspot Instance ids that are generated everytime a new certificate is created.
+Hubspot Instance ids that are generated everytime a new certificate is created, along with the
+urls produced for each certificate (see ledger.py).
 """
 
 import os
-from sqlalchemy import create_engine, Column, Integer
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, inspect, text, Column, BigInteger, Integer, Float, String, Date, DateTime, Text
 from sqlalchemy.ext.declarative import declarative_base
 
 
 package_dir = os.path.abspath(os.path.dirname(__file__))
 db_dir = os.path.join(package_dir, 'uuid.db')
 
-SQLITE_DB = ''.join(['sqlite:///', db_dir])
+load_dotenv()
+
+# Workers on several machines can share one database (see leases.py) by setting CERT_DB_URL
+SQLITE_DB = os.getenv('CERT_DB_URL') or ''.join(['sqlite:///', db_dir])
 
 engine = create_engine(SQLITE_DB) 
 
@@ -23,7 +28,139 @@ class CertIdHistory(Base):
 
     cert_id  = Column(Integer, primary_key=True)
     hs_instance_id = Column(Integer, unique=True)
+    issued_on = Column(Date)
+    linkedin_certificate_url = Column(Text)
+    cle_certificate_url = Column(Text)
+    linkedin_badge = Column(Text)
+    course_name = Column(Text) # Shown when the certificate is verified, see verify_service.py
+    stage = Column(String) # 'issued', 'spooled', 'uploaded' or 'synced', see ledger.py
+    synced_at = Column(DateTime) # When Hubspot got the current urls, None until then
+    updated_at = Column(DateTime)
+
+
+class RunMetric(Base):
+    """One summary row for every run of LinkedInBadgeDueDate.run, used to track trends over time"""
+
+    __tablename__ = "run_metrics"
+
+    id = Column(Integer, primary_key=True)
+    started_at = Column(DateTime, index=True)
+    wall_time = Column(Float) # Seconds
+    records_processed = Column(Integer)
+    errors = Column(Integer)
+    api_calls = Column(Integer)
+    stage_times = Column(Text) # JSON of {stage name: seconds}
+    counters = Column(Text) # JSON of any other counters collected during the run
+
+
+class ProviderCircuit(Base):
+    """State of the circuit breaker of every outside provider, kept between runs"""
+
+    __tablename__ = "provider_circuit"
+
+    provider = Column(String, primary_key=True)
+    state = Column(String)
+    failures = Column(Integer)
+    opened_at = Column(DateTime)
+
+
+class CertRetry(Base):
+    """Hubspot records whose certificates failed, with how often they failed and when to retry"""
+
+    __tablename__ = "cert_retry"
+
+    hs_instance_id = Column(Integer, primary_key=True)
+    attempts = Column(Integer, default=0)
+    next_attempt_at = Column(DateTime, index=True)
+    status = Column(String, default='pending') # 'pending' or 'dead'
+    last_error = Column(Text)
+    updated_at = Column(DateTime)
+
+
+class WorkLease(Base):
+    """Lease of a worker on a Hubspot record, see leases.py"""
+
+    __tablename__ = "work_lease"
+
+    hs_instance_id = Column(Integer, primary_key=True)
+    owner = Column(String)
+    expires_at = Column(DateTime)
+    heartbeat_at = Column(DateTime)
+
+
+class PendingUpload(Base):
+    """Certificate waiting in the local spool to be uploaded to S3, see upload_queue.py"""
+
+    __tablename__ = "pending_upload"
+
+    name = Column(String, primary_key=True)
+    hs_instance_id = Column(Integer, index=True) # Record the certificate belongs to
+    path = Column(Text)
+    size = Column(Integer)
+    attempts = Column(Integer, default=0)
+    next_attempt_at = Column(DateTime) # Failed uploads back off exponentially
+    status = Column(String, default='pending') # 'pending' or 'dead'
+    last_error = Column(Text)
+    created_at = Column(DateTime)
+
+
+class CleCertificate(Base):
+    """CLE certificate rendered the first time it is opened, see cle_service.py"""
+
+    __tablename__ = "cle_certificate"
+
+    cert_id = Column(Integer, primary_key=True)
+    hs_instance_id = Column(Integer)
+    token = Column(String, unique=True, index=True) # Random, the url of the certificate cannot be guessed
+    template_id = Column(Integer)
+    name = Column(Text)
+    body = Column(Text) # JSON sent to PDFGeneratorAPI
+    url = Column(Text) # S3 url once rendered
+    rendered_at = Column(DateTime)
+
+
+class RunCheckpoint(Base):
+    """Where a time-budgeted run stopped a stage, see run_budget.py"""
+
+    __tablename__ = "run_checkpoint"
+
+    stage = Column(String, primary_key=True)
+    stopped_at = Column(DateTime)
+    done = Column(Integer) # Records finished before stopping
+    remaining = Column(Text) # JSON list of the Hubspot ids left, in priority order
+
+
+class DueDateSent(Base):
+    """Last assignment due date sent to Hubspot for a record and the session it was calculated from"""
+
+    __tablename__ = "due_date_sent"
+
+    hs_instance_id = Column(Integer, primary_key=True)
+    live_session_datetime = Column(DateTime) # UTC
+    assignment_due_date = Column(BigInteger) # Unix epoch milliseconds
+    sent_at = Column(DateTime)
+
+
+def add_missing_columns(engine):
+    """create_all does not change tables that already exist, so add the columns that were added
+    to a model after its table was created"""
+    inspector = inspect(engine)
+    table_names = inspector.get_table_names()
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if table.name not in table_names:
+                continue
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} '
+                                      f'{column.type.compile(engine.dialect)}'))
 
 
-Base.metadata.create_all(engine)
-engine.dispose()
\ No newline at end of file
+def create_tables():
+    """Create the tables that do not exist yet and add the missing columns. Every entry point
+    calls this before it uses the database, so importing the models has no side effects (e.g. in
+    the worker processes of pdf_optimizer.py, which import the main module again)."""
+    Base.metadata.create_all(engine)
+    add_missing_columns(engine)
+    engine.dispose()
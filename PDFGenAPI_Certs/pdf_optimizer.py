@@ -0,0 +1,127 @@
+"""
+Module to make the certificates smaller before they are uploaded. With PDF_OPTIMIZE=1 in the .env
+file every rendered certificate is rewritten by pikepdf in a pool of PDF_OPTIMIZE_WORKERS
+processes: unused resources are dropped, streams are recompressed, objects are packed into object
+streams and the file is linearized so a browser can show it before it is fully downloaded. The
+smaller of the two files is uploaded and the bytes saved are added to the run metrics.
+
+pikepdf is optional (pip install pikepdf), without it certificates are uploaded as rendered. The
+workers run pdf_optimizer_worker.py. In write-behind mode certificates are optimized by the upload
+drainer, so spooling a certificate never waits on a worker.
+"""
+
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from dotenv import load_dotenv
+
+from run_metrics import metrics
+
+try:
+    import pdf_optimizer_worker
+except ImportError: # pikepdf is not installed
+    pdf_optimizer_worker = None
+
+load_dotenv()
+
+logger = logging.getLogger(F'LinkedInAssignDueDateUpdate.{__name__}')
+
+PDF_OPTIMIZE = os.getenv('PDF_OPTIMIZE', '').lower() in ('1', 'true', 'yes')
+PDF_OPTIMIZE_WORKERS = int(os.getenv('PDF_OPTIMIZE_WORKERS', 0)) or min(4, os.cpu_count() or 1)
+PDF_OPTIMIZE_TIMEOUT = float(os.getenv('PDF_OPTIMIZE_TIMEOUT', 30)) # Seconds, the certificate is uploaded as is after
+
+_pool = None
+_pool_lock = threading.Lock()
+_warned = False
+
+
+class _OptimizerPool:
+    def __init__(self, workers=PDF_OPTIMIZE_WORKERS):
+        """
+        Pool of worker processes rewriting pdfs. Every worker reports its pid when it starts, so a
+        pool with a stuck worker can be killed.
+
+        Args:
+            workers (int, optional): worker processes. Defaults to PDF_OPTIMIZE_WORKERS.
+        """
+        # spawn, forking a process with the stage threads running could copy a held lock
+        context = multiprocessing.get_context('spawn')
+        self._pids = context.SimpleQueue()
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                            initializer=pdf_optimizer_worker.report_pid, initargs=(self._pids,))
+
+    def submit(self, body):
+        return self.executor.submit(pdf_optimizer_worker.rewrite, body)
+
+    def kill(self):
+        """Kill the workers and shut the pool down, shutdown() alone waits for a busy worker"""
+        pids = set()
+        while not self._pids.empty():
+            pids.add(self._pids.get())
+        for pid in pids:
+            try:
+                os.kill(pid, getattr(signal, 'SIGKILL', signal.SIGTERM))
+            except (ProcessLookupError, PermissionError):
+                pass
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = _OptimizerPool()
+        return _pool
+
+
+def _discard_pool(pool):
+    """Stop a pool with a stuck or dead worker, the next certificate starts a new one"""
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+    pool.kill()
+
+
+def optimize_pdf(body):
+    """Smaller version of a certificate, or the certificate itself when it could not be made
+    smaller or optimizing is off. Never fails the upload.
+
+    Args:
+        body (bytes): the pdf as rendered
+
+    Returns:
+        (bytes): the pdf to upload
+    """
+    global _warned
+    if not PDF_OPTIMIZE:
+        return body
+    if pdf_optimizer_worker is None:
+        if not _warned:
+            _warned = True
+            logger.warning('PDF_OPTIMIZE is set but pikepdf is not installed, certificates are uploaded as rendered.')
+        return body
+    pool = _get_pool()
+    try:
+        optimized = pool.submit(body).result(timeout=PDF_OPTIMIZE_TIMEOUT)
+    except (BrokenProcessPool, TimeoutError) as e:
+        logger.warning(f'Could not optimize a certificate in {PDF_OPTIMIZE_TIMEOUT}s or a worker died, '
+                       f'restarting the workers and uploading it as rendered: {e!r}')
+        _discard_pool(pool)
+        metrics.incr('pdf_optimize_failed')
+        return body
+    except Exception as e:
+        logger.warning(f'Could not optimize a certificate, uploading it as rendered: {e!r}')
+        metrics.incr('pdf_optimize_failed')
+        return body
+    metrics.incr('pdf_bytes_rendered', len(body))
+    if len(optimized) >= len(body):
+        return body
+    metrics.incr('pdf_bytes_saved', len(body) - len(optimized))
+    return optimized
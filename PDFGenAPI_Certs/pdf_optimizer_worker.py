@@ -0,0 +1,35 @@
+"""
+Functions run by the worker processes of pdf_optimizer.py. Kept apart so the workers only need the
+standard library and pikepdf to run them.
+"""
+
+import io
+import os
+
+import pikepdf
+
+
+def report_pid(pids):
+    """Tell the pool the pid of this worker when it starts
+
+    Args:
+        pids (multiprocessing.SimpleQueue): queue the pool reads the pids of its workers from
+    """
+    pids.put(os.getpid())
+
+
+def rewrite(body):
+    """Rewrite a pdf with pikepdf
+
+    Args:
+        body (bytes): the pdf
+
+    Returns:
+        (bytes): the rewritten pdf
+    """
+    with pikepdf.open(io.BytesIO(body)) as pdf:
+        pdf.remove_unreferenced_resources()
+        out = io.BytesIO()
+        pdf.save(out, compress_streams=True, recompress_flate=True,
+                 object_stream_mode=pikepdf.ObjectStreamMode.generate, linearize=True)
+    return out.getvalue()
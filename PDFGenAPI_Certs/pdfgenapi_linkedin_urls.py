@@ -6,6 +6,8 @@ to the student's LinkedIn account when clicked.
 
 import requests
 import os
+import random
+import threading
 import logging
 import json
 import time
@@ -18,7 +20,14 @@ from sqlalchemy.exc import SQLAlchemyError, IntegrityError
 from sqlalchemy.orm import sessionmaker, scoped_session
 
 from models import CertIdHistory, SQLITE_DB 
+from ledger import SPOOLED, SYNCED, UPLOADED, format_cert_id, get_or_create_entry, mark_uploaded, update_entry
 from aws_bucket import transfer_cert_to_aws
+from upload_queue import WRITE_BEHIND, enqueue_upload, has_pending_uploads
+from cle_service import CLE_ON_DEMAND, register_cle_cert
+from render_backends import CLE, COMPLETION, get_renderer
+from circuit_breaker import guarded_call, get_timeout
+from jwt_provider import JwtProvider
+from run_metrics import metrics
 
 import pdf_generator_api_client
 
@@ -36,33 +45,61 @@ load_dotenv()
 
 logger = logging.getLogger(F'LinkedInAssignDueDateUpdate.{__name__}')
 
-PDFGENAPI_JWT = os.environ['PDFGENAPI_JWT']
+# Fraction (0 to 1) of successful API requests to log at DEBUG level
+API_LOG_SAMPLE_RATE = float(os.getenv('API_LOG_SAMPLE_RATE', 1))
 
-configuration = pdf_generator_api_client.Configuration(
-    host = "https://us1.pdfgeneratorapi.com/api/v4"
-)
-
-# The client must configure the authentication and authorization parameters
-# in accordance with the API server security policy.
-# Examples for each auth method are provided below, use the example that
-# satisfies your auth use case.
+# Short-lived tokens are signed from PDFGENAPI_KEY/_WORKSPACE/_SECRET when they are set, see
+# jwt_provider.py. Otherwise the long-lived PDFGENAPI_JWT is used.
+jwt_provider = JwtProvider.from_env()
+PDFGENAPI_JWT = None if jwt_provider else os.environ['PDFGENAPI_JWT']
+# Can be pointed somewhere else, e.g. at the stand-in of the benchmarks
+PDFGENAPI_HOST = os.getenv('PDFGENAPI_HOST', "https://us1.pdfgeneratorapi.com/api/v4")
 
-# Configure Bearer authorization (JWT): JSONWebTokenAuth
+# Configure the host and Bearer authorization (JWT): JSONWebTokenAuth in one configuration, a
+# second Configuration would go back to the default host of the client
 configuration = pdf_generator_api_client.Configuration(
+    host = PDFGENAPI_HOST,
     access_token = PDFGENAPI_JWT
 )
 
+# One API client (and connection pool) shared by every render of every stage, created on first use.
+# The token refresher is started along with it rather than on import.
+_api_client = None
+_api_client_lock = threading.Lock()
+
+
+def get_api_client():
+    global _api_client
+    with _api_client_lock:
+        if _api_client is None:
+            if jwt_provider:
+                jwt_provider.attach(configuration)
+            _api_client = pdf_generator_api_client.ApiClient(configuration)
+        return _api_client
+
+
 def api_log(res, success_code):
+    """
+    Log the response of an API request. Failures are always logged in full. Successful requests
+    are only logged when DEBUG is enabled, and then only a sampled fraction of them
+    (API_LOG_SAMPLE_RATE) so log volume does not grow with the number of requests.
+
+    Args:
+        res: response of the request
+        success_code (int): status code expected on success
+
+    Returns:
+        res: the response on success, otherwise None
+    """
+    metrics.incr('api_calls')
     if res.status_code == success_code:
-        logger.debug(F'"METHOD": "{res.request.method}", '
-                    F'"STATUS_CODE": "{res.status_code}",'
-                    F'"URL": "{res.url}"', exc_info=True)
+        if logger.isEnabledFor(logging.DEBUG) and random.random() < API_LOG_SAMPLE_RATE:
+            logger.debug('"METHOD": "%s", "STATUS_CODE": "%s","URL": "%s"',
+                         res.request.method, res.status_code, res.url)
         return res
     else:
-        logger.warning(F'"METHOD": "{res.request.method}", '
-                       F'"STATUS_CODE": "{res.status_code}",'
-                       F'"URL": "{res.url}",'
-                       F'"FAIL RESPONSE": "{res.text}"', exc_info=True)
+        logger.warning('"METHOD": "%s", "STATUS_CODE": "%s","URL": "%s","FAIL RESPONSE": "%s"',
+                       res.request.method, res.status_code, res.url, res.text)
         return None
 
 
@@ -83,7 +120,10 @@ class PdfGenAPILinkedIn:
         self.hs_obj_id = hs_record['properties']['hs_object_id']
         self.cle = hs_record['properties']['cle']
         self.cle_state_bar_num = hs_record['properties']['cle_state_bar_number__and_state__if_not_specified_above_']
+        self.email = hs_record['properties'].get('email')
         self.date = date
+        self.entry = None # Ledger entry of the record, see ledger.py
+        self.issued_on = date # Issue date of the certificate, earlier when it was reused
         
         self.template_id_compl_cert = 477969 # Template 1 PDFGeneratorAPI ID
         # Body to house information to be added to Template 1
@@ -105,38 +145,79 @@ class PdfGenAPILinkedIn:
 
     def create_cert_id(self):
         """Each time a certificate is created, generate and ID that will be added to a SQLite
-        Table for historical purposes
+        Table for historical purposes. A record that failed before keeps the ID of its earlier
+        attempt, along with any urls that were already produced for it.
 
         Returns:
             cert_id (str): The unique id of the certificate in nnn-nnnnn-nn format
         """
-        stmt = CertIdHistory(hs_instance_id=self.hs_obj_id)
-        self.session.add(stmt)
-        self.session.commit()
-        # Get the last id created, and fill in leading 0s so that the number is 10 digits total
-        cert_id_query = str(self.session.query(CertIdHistory.cert_id).filter_by(hs_instance_id=self.hs_obj_id).first()[0]).zfill(10)
-        cert_id = f'{cert_id_query[:3]}-{cert_id_query[3:8]}-{cert_id_query[8:]}' 
-        return cert_id 
+        self.entry = get_or_create_entry(self.session, self.hs_obj_id, self.date, self.course_name)
+        return format_cert_id(self.entry.cert_id)
 
 
     def gather_urls(self):
         """
         Main function to gather the urls of the certs and linkedin badge to be input into 
-        the url dictionary
+        the url dictionary. Failures are raised so the runner can schedule the record for a retry.
+        Every url is stored in the ledger as soon as it is produced, and urls already in the ledger
+        are reused instead of rendering and uploading the certificate again.
         """
-        try:
-            base64_compl_cert, name_compl_cert = self.create_cert(self.template_id_compl_cert, self.body_completion_cert, self.name_compl_cert)
-            self.urls['linkedin_certificate_url'] = transfer_cert_to_aws(base64_compl_cert, name_compl_cert)
-            self.urls['unique_certificate_id'] = self.create_cert_id()
-            self.urls['linkedin_badge'] = self.create_linkedin_url(self.urls['linkedin_certificate_url']) 
-            
-            base64_cle_cert, name_cle_cert = self.create_cert(self.template_id_cle_cert, self.body_cle_cert, self.name_cle_cert)
-            self.urls['cle_certificate_url'] = transfer_cert_to_aws(base64_cle_cert, name_cle_cert)
-        except Exception as e:
-            logger.error(e, exc_info=True)
-            pass
+        self.urls['unique_certificate_id'] = self.create_cert_id()
+        entry = self.entry
+
+        if not entry.linkedin_certificate_url:
+            base64_compl_cert, name_compl_cert = get_renderer().render(COMPLETION, self)
+            update_entry(self.session, entry, linkedin_certificate_url=self.upload_cert(base64_compl_cert, name_compl_cert),
+                         issued_on=self.date, linkedin_badge=None)
+        self.urls['linkedin_certificate_url'] = entry.linkedin_certificate_url
+
+        if not entry.linkedin_badge:
+            update_entry(self.session, entry, linkedin_badge=self.create_linkedin_url(entry.linkedin_certificate_url))
+        self.urls['linkedin_badge'] = entry.linkedin_badge
+
+        # Only students with CLE information get a CLE certificate
+        if self.has_cle() and not entry.cle_certificate_url:
+            if CLE_ON_DEMAND:
+                # Rendered by cle_service.py the first time someone opens it
+                cle_url = register_cle_cert(self.session, entry, self.template_id_cle_cert, self.body_cle_cert, self.name_cle_cert)
+            else:
+                base64_cle_cert, name_cle_cert = get_renderer().render(CLE, self)
+                cle_url = self.upload_cert(base64_cle_cert, name_cle_cert)
+            update_entry(self.session, entry, cle_certificate_url=cle_url)
+        if entry.cle_certificate_url:
+            self.urls['cle_certificate_url'] = entry.cle_certificate_url
+
+        if entry.stage != SYNCED:
+            # A spooled certificate only counts as uploaded once the upload queue verified it. The
+            # stage is set before checking the queue, so an upload finishing in between is not missed.
+            update_entry(self.session, entry, stage=SPOOLED if WRITE_BEHIND else UPLOADED)
+            if WRITE_BEHIND and not has_pending_uploads(self.session, entry.hs_instance_id):
+                mark_uploaded(self.session, entry.hs_instance_id)
+                self.session.refresh(entry)
+        self.issued_on = entry.issued_on
+
+    def template(self, kind):
+        """PDFGeneratorAPI template id, body and certificate name of the completion or CLE certificate"""
+        if kind == CLE:
+            return self.template_id_cle_cert, self.body_cle_cert, self.name_cle_cert
+        return self.template_id_compl_cert, self.body_completion_cert, self.name_compl_cert
+
+    def has_cle(self):
+        """Whether the student has CLE credits or a state bar number to put on a CLE certificate"""
+        return any(str(value).strip() for value in (self.cle, self.cle_state_bar_num) if value is not None)
+
+    def upload_cert(self, cert_base64, name):
+        """Upload a certificate to AWS and return its url, raising when the upload failed. In
+        write-behind mode the certificate is only queued and the url is returned right away."""
+        if WRITE_BEHIND:
+            return enqueue_upload(self.session, cert_base64, name, self.hs_obj_id)
+        url = transfer_cert_to_aws(cert_base64, name)
+        if url is None:
+            raise RuntimeError(f'Upload of "{name}" to S3 failed.')
+        return url
         
-    def create_cert(self, template_id, body, name):
+    @staticmethod
+    def create_cert(template_id, body, name):
         """Function to house PDFGeneratorAPI's code to generate a certificate.
 
         Args:
@@ -147,22 +228,19 @@ class PdfGenAPILinkedIn:
         Returns:
             base64, name(str): the base64 of the cert to be added to AWS and name of cert
         """
-    # Enter a context with an instance of the API client
-        with pdf_generator_api_client.ApiClient(configuration) as api_client:
-            # Create an instance of the API class
-            api_instance = documents_api.DocumentsApi(api_client)
-            body = body # {str: (bool, date, datetime, dict, float, int, list, str, none_type)} | Data used to generate the PDF. This can be JSON encoded string or a public URL to your JSON file.
-            name = name # str | Document name, returned in the meta data. (optional)
-            format = "pdf" # str | Document format. The zip option will return a ZIP file with PDF files. (optional) (default to "pdf")
-            output = "base64" # str | Response format. "I" is used to return the file inline. With the url option, the document is stored for 30 days and automatically deleted. (optional) (default to "base64")
-
-            try:
-                # Generate document
-                api_response = api_instance.merge_template(template_id, body, name=name, format=format, output=output)
-                return api_response['response'], name
-            except pdf_generator_api_client.ApiException as e:
-                logger.error(e, exc_info=True)
-                pass
+        # Create an instance of the API class on the shared API client
+        api_instance = documents_api.DocumentsApi(get_api_client())
+        body = body # {str: (bool, date, datetime, dict, float, int, list, str, none_type)} | Data used to generate the PDF. This can be JSON encoded string or a public URL to your JSON file.
+        name = name # str | Document name, returned in the meta data. (optional)
+        format = "pdf" # str | Document format. The zip option will return a ZIP file with PDF files. (optional) (default to "pdf")
+        output = "base64" # str | Response format. "I" is used to return the file inline. With the url option, the document is stored for 30 days and automatically deleted. (optional) (default to "base64")
+
+        # Generate document. An ApiException is left to the runner to log and retry later.
+        metrics.incr('api_calls')
+        api_response = guarded_call('pdfgenapi', api_instance.merge_template, template_id, body,
+                                     name=name, format=format, output=output,
+                                     _request_timeout=get_timeout('pdfgenapi'))
+        return api_response['response'], name
 
 
     def create_linkedin_url(self, merged_doc_url, org_id=12958828):
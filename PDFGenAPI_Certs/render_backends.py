@@ -0,0 +1,256 @@
+"""
+Module to render certificates through more than one provider. Every provider is a backend with the
+same interface: render(kind, record) returns the base64 of the pdf and its name, so the certificate
+ends up in S3 the same way whichever backend rendered it.
+
+RENDER_BACKENDS in the .env file lists the backends in order of preference, e.g.
+RENDER_BACKENDS=pdfgenapi,pandadoc. With more than one backend a certificate is sent to the first
+one, and when it takes longer than that backend usually does (its p95 latency), the next backend
+is asked as well and whichever answers first is used (a hedged request). A backend that fails or
+whose circuit is open fails over to the next one straight away.
+
+The Pandadoc backend needs PANDA_API, PANDA_TEMPLATE_ID and PANDA_FOLDER_ID, and a Pandadoc
+template with the same tokens as the one in Pandadoc_Certs. It only renders the completion
+certificate, CLE certificates are always rendered by PDFGeneratorAPI.
+"""
+
+import abc
+import base64
+import json
+import logging
+import os
+import statistics
+import threading
+import time
+
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import requests
+from dotenv import load_dotenv
+
+from circuit_breaker import CircuitOpenError, guarded_call, get_timeout
+from run_metrics import metrics
+
+load_dotenv()
+
+logger = logging.getLogger(F'LinkedInAssignDueDateUpdate.{__name__}')
+
+RENDER_BACKENDS = [name.strip() for name in os.getenv('RENDER_BACKENDS', 'pdfgenapi').lower().split(',') if name.strip()]
+# Seconds to wait before hedging until a backend has enough renders to know its p95
+HEDGE_AFTER = float(os.getenv('HEDGE_AFTER', 15))
+# Most renders that may be hedged, as a fraction of all renders, so a slow provider does not
+# double the load on the other one
+HEDGE_MAX_RATE = float(os.getenv('HEDGE_MAX_RATE', 0.2))
+LATENCY_WINDOW = 200 # Renders kept per backend to work out its p95
+MIN_SAMPLES = 20 # Renders needed before the p95 is used instead of HEDGE_AFTER
+
+PANDADOC_API = os.getenv('PANDA_API_URL', 'https://api.pandadoc.com/public/v1')
+# Seconds to wait for a new Pandadoc document to be ready (document.draft) before downloading it
+PANDA_STATUS_WAIT = float(os.getenv('PANDA_STATUS_WAIT', 30))
+
+COMPLETION = 'completion'
+CLE = 'cle'
+
+
+class RenderBackend(abc.ABC):
+    """Interface of a rendering backend"""
+
+    name = None
+    kinds = ()
+
+    def supports(self, kind):
+        return kind in self.kinds
+
+    @abc.abstractmethod
+    def render(self, kind, record):
+        """Render a certificate
+
+        Args:
+            kind (str): COMPLETION or CLE
+            record (PdfGenAPILinkedIn): record to render the certificate of
+
+        Returns:
+            base64, name (str): the base64 of the pdf and the name of the certificate
+        """
+
+
+class PdfGenAPIBackend(RenderBackend):
+    """Renders the templates on PDFGeneratorAPI"""
+
+    name = 'pdfgenapi'
+    kinds = (COMPLETION, CLE)
+
+    def render(self, kind, record):
+        return record.create_cert(*record.template(kind))
+
+
+class PandadocBackend(RenderBackend):
+    """Creates a document from a Pandadoc template and downloads it as a pdf"""
+
+    name = 'pandadoc'
+    kinds = (COMPLETION,)
+
+    def __init__(self):
+        self.headers = {'Authorization': f'API-Key {os.environ["PANDA_API"]}', 'Content-Type': 'application/json'}
+        self.template_id = os.environ['PANDA_TEMPLATE_ID']
+        self.folder_id = os.environ['PANDA_FOLDER_ID']
+
+    def _request(self, method, path, success_code, **kwargs):
+        res = guarded_call('pandadoc', requests.request, method, f'{PANDADOC_API}{path}', headers=self.headers,
+                           timeout=get_timeout('pandadoc'), **kwargs)
+        metrics.incr('api_calls')
+        if res.status_code != success_code:
+            raise RuntimeError(f'Pandadoc {method} {path} answered {res.status_code}: {res.text[:500]}')
+        return res
+
+    def render(self, kind, record):
+        _, _, name = record.template(kind)
+        payload = {
+            "name": name,
+            "template_uuid": self.template_id,
+            "folder_uuid": self.folder_id,
+            "recipients": [{"email": record.email}] if record.email else [],
+            "tokens": [
+                {"name": "Student FName Student LName", "value": f"{record.firstname} {record.lastname}"},
+                {"name": "Course Name", "value": record.course_name},
+                {"name": "Date Issued", "value": str(record.date)}
+            ]
+        }
+        doc_id = self._request('POST', '/documents', 201, data=json.dumps(payload)).json()['id']
+        try:
+            # A new document is document.uploaded for a few seconds before it can be downloaded
+            deadline = time.monotonic() + PANDA_STATUS_WAIT
+            while self._request('GET', f'/documents/{doc_id}', 200).json()['status'] != 'document.draft':
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f'Pandadoc document {doc_id} was not ready after {PANDA_STATUS_WAIT:.0f}s.')
+                time.sleep(1)
+            pdf = self._request('GET', f'/documents/{doc_id}/download', 200).content
+        finally:
+            # The pdf is kept on S3, the document is not needed on Pandadoc
+            try:
+                self._request('DELETE', f'/documents/{doc_id}', 204)
+            except Exception as e:
+                logger.warning(f'Could not delete Pandadoc document {doc_id}: {e}')
+        return base64.b64encode(pdf).decode(), name
+
+
+BACKENDS = {backend.name: backend for backend in (PdfGenAPIBackend, PandadocBackend)}
+
+
+class LatencyTracker:
+    def __init__(self, window=LATENCY_WINDOW):
+        """Recent render times of a backend"""
+        self._times = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, seconds):
+        with self._lock:
+            self._times.append(seconds)
+
+    def p95(self, default=HEDGE_AFTER):
+        """95th percentile of the recent render times, the default until there are enough of them"""
+        with self._lock:
+            if len(self._times) < MIN_SAMPLES:
+                return default
+            return statistics.quantiles(self._times, n=20)[-1]
+
+
+class HedgedRenderer:
+    def __init__(self, backends):
+        """
+        Class to send every certificate to the preferred backend, hedge it on the next backend
+        when the preferred one is slow and fail over when it fails
+
+        Args:
+            backends (list): RenderBackend objects in order of preference
+        """
+        self.backends = backends
+        self.latency = {backend.name: LatencyTracker() for backend in backends}
+        self._executor = ThreadPoolExecutor(max_workers=4 * len(backends), thread_name_prefix='render')
+        self._lock = threading.Lock()
+        self._renders = self._hedges = 0
+
+    def _timed(self, backend, kind, record):
+        start = time.perf_counter()
+        result = backend.render(kind, record)
+        self.latency[backend.name].add(time.perf_counter() - start)
+        return result
+
+    def _may_hedge(self):
+        with self._lock:
+            if self._hedges < HEDGE_MAX_RATE * self._renders:
+                self._hedges += 1
+                return True
+            return False
+
+    def render(self, kind, record):
+        """Render a certificate on the first backend to succeed
+
+        Args:
+            kind (str): COMPLETION or CLE
+            record (PdfGenAPILinkedIn): record to render the certificate of
+
+        Returns:
+            base64, name (str): the base64 of the pdf and the name of the certificate
+        """
+        candidates = [backend for backend in self.backends if backend.supports(kind)]
+        if not candidates:
+            raise ValueError(f'No backend in RENDER_BACKENDS renders {kind} certificates.')
+        with self._lock:
+            self._renders += 1
+        if len(candidates) == 1:
+            return self._timed(candidates[0], kind, record)
+
+        waiting = list(candidates)
+        running = {}
+        errors = []
+
+        def start(reason=None):
+            backend = waiting.pop(0)
+            if reason:
+                logger.info(f'{reason}, rendering "{record.template(kind)[2]}" on {backend.name}.')
+            running[self._executor.submit(self._timed, backend, kind, record)] = backend
+
+        start()
+        # Hedge once the first backend takes longer than it usually does
+        timeout = self.latency[candidates[0].name].p95()
+        while running:
+            done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+            timeout = None
+            if not done:
+                if waiting and self._may_hedge():
+                    metrics.incr('render_hedged')
+                    start(f'{candidates[0].name} is slow')
+                continue
+            for future in done:
+                backend = running.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    errors.append(e)
+                    if waiting and not running:
+                        metrics.incr('render_failover')
+                        start(f'{backend.name} failed ({e})')
+                    continue
+                # A hedged render still running is left to finish in the background
+                metrics.incr(f'rendered_{backend.name}')
+                return result
+        # Let the runner stop when every backend is down, otherwise retry the record later
+        raise next((e for e in errors if not isinstance(e, CircuitOpenError)), errors[0])
+
+
+_renderer = None
+_renderer_lock = threading.Lock()
+
+
+def get_renderer():
+    """Renderer shared by every record, with the backends listed in RENDER_BACKENDS"""
+    global _renderer
+    with _renderer_lock:
+        if _renderer is None:
+            unknown = set(RENDER_BACKENDS) - set(BACKENDS)
+            if unknown:
+                raise ValueError(f'Unknown render backend(s) {sorted(unknown)} in RENDER_BACKENDS.')
+            _renderer = HedgedRenderer([BACKENDS[name]() for name in RENDER_BACKENDS])
+        return _renderer
@@ -0,0 +1,139 @@
+"""
+Module with a durable retry queue for Hubspot records whose certificates failed.
+
+Every failure of a record adds an attempt and pushes its next attempt back exponentially
+(RETRY_BASE_DELAY * 2 ** (attempts - 1) seconds, at most RETRY_MAX_DELAY). Records are skipped by
+the runner until their next attempt is due. After RETRY_MAX_ATTEMPTS failures a record is
+dead-lettered and left alone until it is requeued by hand.
+
+Usage:
+    python retry_queue.py list [--dead]
+    python retry_queue.py requeue <hs_instance_id>
+"""
+
+import argparse
+import datetime
+import logging
+import os
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from models import CertRetry, SQLITE_DB, create_tables
+
+logger = logging.getLogger(F'LinkedInAssignDueDateUpdate.{__name__}')
+
+MAX_ATTEMPTS = int(os.getenv('RETRY_MAX_ATTEMPTS', 6))
+BASE_DELAY = int(os.getenv('RETRY_BASE_DELAY', 3600)) # Seconds, one cron cycle
+MAX_DELAY = int(os.getenv('RETRY_MAX_DELAY', 7 * 24 * 3600)) # Seconds
+
+PENDING = 'pending'
+DEAD = 'dead'
+
+
+class RetryQueue:
+    def __init__(self, session):
+        """
+        Class to decide which failed records are due for another attempt. All entries are read
+        with one query up front so checking a record does not touch the database.
+
+        Args:
+            session: SQLAlchemy session bound to the local database
+        """
+        self.session = session
+        self._entries = {row.hs_instance_id: row for row in session.query(CertRetry).all()}
+
+    def is_due(self, hs_instance_id, now=None):
+        """Whether a record should be worked on in this run
+
+        Args:
+            hs_instance_id (int): Hubspot id of the record
+            now (datetime, optional): Defaults to the current UTC time.
+
+        Returns:
+            (bool): True for records that never failed or whose next attempt is due
+        """
+        entry = self._entries.get(int(hs_instance_id))
+        if entry is None:
+            return True
+        if entry.status == DEAD:
+            return False
+        return entry.next_attempt_at <= (now or datetime.datetime.utcnow())
+
+    def record_failure(self, hs_instance_id, error):
+        """Add a failed attempt for a record and schedule its next attempt
+
+        Args:
+            hs_instance_id (int): Hubspot id of the record
+            error (Exception): why the attempt failed
+
+        Returns:
+            entry (CertRetry): the updated entry
+        """
+        hs_instance_id = int(hs_instance_id)
+        now = datetime.datetime.utcnow()
+        entry = self._entries.get(hs_instance_id)
+        if entry is None:
+            entry = CertRetry(hs_instance_id=hs_instance_id, attempts=0, status=PENDING)
+            self.session.add(entry)
+            self._entries[hs_instance_id] = entry
+        entry.attempts += 1
+        entry.last_error = repr(error)[:1000]
+        entry.updated_at = now
+        if entry.attempts >= MAX_ATTEMPTS:
+            entry.status = DEAD
+            logger.error(f'Record {hs_instance_id} failed {entry.attempts} times and was dead-lettered. '
+                         f'Requeue it with "python retry_queue.py requeue {hs_instance_id}" once fixed.')
+        else:
+            delay = min(MAX_DELAY, BASE_DELAY * 2 ** (entry.attempts - 1))
+            entry.next_attempt_at = now + datetime.timedelta(seconds=delay)
+            logger.info(f'Record {hs_instance_id} failed {entry.attempts} time(s), next attempt after '
+                        f'{entry.next_attempt_at:%Y-%m-%d %H:%M:%S} UTC.')
+        self.session.commit()
+        return entry
+
+    def record_success(self, hs_instance_id):
+        """Remove a record from the queue once its certificate went through"""
+        entry = self._entries.pop(int(hs_instance_id), None)
+        if entry is not None:
+            self.session.delete(entry)
+            self.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Inspect the certificate retry queue.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    list_parser = subparsers.add_parser('list', help='List the queued records')
+    list_parser.add_argument('--dead', action='store_true', help='Only list dead-lettered records')
+    requeue_parser = subparsers.add_parser('requeue', help='Retry a record on the next run')
+    requeue_parser.add_argument('hs_instance_id', type=int)
+    args = parser.parse_args()
+
+    create_tables()
+    engine = create_engine(SQLITE_DB)
+    session = sessionmaker(bind=engine)()
+    try:
+        if args.command == 'list':
+            query = session.query(CertRetry).order_by(CertRetry.next_attempt_at)
+            if args.dead:
+                query = query.filter_by(status=DEAD)
+            for entry in query.all():
+                print(f'{entry.hs_instance_id:<14}{entry.status:<9}{entry.attempts:>3} attempt(s)  '
+                      f'next: {entry.next_attempt_at or "-"}  last error: {entry.last_error}')
+        elif args.command == 'requeue':
+            entry = session.query(CertRetry).filter_by(hs_instance_id=args.hs_instance_id).first()
+            if entry is None:
+                print(f'Record {args.hs_instance_id} is not in the retry queue.')
+                return
+            entry.status = PENDING
+            entry.attempts = 0
+            entry.next_attempt_at = datetime.datetime.utcnow()
+            session.commit()
+            print(f'Record {args.hs_instance_id} will be retried on the next run.')
+    finally:
+        session.close()
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,9 @@
 """Main module to gather cert urls, LinkedIn Badge url, and assignment due date."""
 
+import argparse
+import copy
 import json
+import os
 
 import datetime
 from calendar import timegm
@@ -10,8 +13,19 @@ from logger import get_logger
 
 from pdfgenapi_linkedin_urls import PdfGenAPILinkedIn
 from due_date import DueDate
+from circuit_breaker import CircuitOpenError, guarded_call, load_breakers, save_breakers
+from leases import LEASES_ENABLED, LeaseManager
+from ledger import hs_properties, mark_synced, pending_sync
+from retry_queue import RetryQueue
+from run_budget import (DUE_DATE_BATCH, DUE_DATE_RESERVE, RUN_BUDGET, RUN_BUDGET_RESERVE, RunBudget, completion_order,
+                        load_checkpoint, save_checkpoint)
+from run_metrics import metrics
+from run_profiler import profiler
+from http_recorder import HttpRecorder, HttpReplayer
+from stages import Stage, StageSkipped, run_stages
+from upload_queue import WRITE_BEHIND, UploadDrainer
 
-from models import SQLITE_DB
+from models import SQLITE_DB, create_tables
 
 from sqlalchemy import create_engine
 from sqlalchemy.exc import SQLAlchemyError, IntegrityError
@@ -59,7 +73,8 @@ class LinkedInBadgeDueDate:
                 "course_name", 
                 "linkedin_company_id",
                 "cle",
-                "cle_state_bar_number__and_state__if_not_specified_above_"
+                "cle_state_bar_number__and_state__if_not_specified_above_",
+                "email"
             ],
             "limit": 100,
             "after": 0
@@ -72,11 +87,71 @@ class LinkedInBadgeDueDate:
         self.logger = get_logger('LinkedInAssignDueDateUpdate')
         # Payload to update all record with cert urls, LinkedIn Badge url, and assignment_due_date
         self.update_payload_hs = {'inputs': []}
+        # Leases on the records this worker is working on when several workers share the records
+        self.leases = LeaseManager(self.session) if LEASES_ENABLED else None
+        # Wall-clock budget of the run, None to work through everything
+        self.budget = None
         # Change the object here during projection
 
-    def run(self):
-        self._linkedinbadge()
-        self._assign_date()
+    def run(self, budget=RUN_BUDGET):
+        """
+        Create the certificates and due dates and update them on Hubspot
+
+        Args:
+            budget (float, optional): seconds the run may take, 0 for no limit. The most valuable
+                work is done first and the rest is left for the next run. Defaults to RUN_BUDGET.
+        """
+        metrics.reset()
+        self.budget = RunBudget(budget) if budget else None
+        load_breakers(self.session)
+        # Upload queued certificates in the background while Hubspot is being updated
+        drainer = UploadDrainer(self.engine) if WRITE_BEHIND else None
+        if drainer:
+            drainer.start()
+        # The certificates and the due dates do not depend on each other, so they run side by side
+        stages = [Stage('linkedinbadge', self._in_stage(profiler.wrap('linkedinbadge', self._linkedinbadge))),
+                  Stage('assign_date', self._in_stage(profiler.wrap('assign_date', self._assign_date)))]
+        if drainer:
+            stages.append(Stage('upload_drain', drainer.stop, depends_on=['linkedinbadge']))
+        profiler.start()
+        try:
+            _, errors = run_stages(stages)
+        finally:
+            if drainer and drainer.is_alive():
+                drainer.stop()
+            profiler.stop()
+        self.save_run_state()
+        failed = [error for error in errors.values() if not isinstance(error, StageSkipped)]
+        if failed:
+            raise failed[0]
+
+    def _in_stage(self, func):
+        """Wrap a stage so the database session of its thread is closed when it is done"""
+        def stage():
+            try:
+                return func()
+            finally:
+                self.session.remove()
+        return stage
+
+    def save_run_state(self):
+        """Store the circuit breaker states and the run summary in the local database. Never fails
+        the run."""
+        try:
+            save_breakers(self.session)
+            row = metrics.save(self.session)
+            self.logger.info(f'Run took {row.wall_time:.1f}s for {row.records_processed} record(s), '
+                             f'{row.api_calls} API call(s) and {row.errors} error(s).')
+            if metrics.counters.get('pdf_bytes_rendered'):
+                saved, rendered = metrics.counters['pdf_bytes_saved'], metrics.counters['pdf_bytes_rendered']
+                self.logger.info(f'Optimizing the certificates saved {saved} of {rendered} byte(s) '
+                                 f'({saved / rendered:.0%}).')
+        except SQLAlchemyError as s:
+            self.logger.error(s, exc_info=True)
+            self.session.rollback()
+        finally:
+            self.session.close()
+            self.engine.dispose()
 
     def get_session(self):
         """Creates a new database self.session for instant use"""
@@ -90,54 +165,248 @@ class LinkedInBadgeDueDate:
         """Main method to gather the cert urls and Linkedin Badge url and update on Hubspot"""
         self.logger.info(f'--- BEGIN LINKEDIN CERTIFICATIONS CREATION ({self.isodate}) ---\n')
 
-        badge = LinkedInBadgeDueDate()
+        reconciled = self._reconcile()
 
         self.logger.info('Retrieving data from Hubspot...')
-        instances_json = search_all_records(self.instance_obj, self._payload_search_hs)
+        instances_json = guarded_call('hubspot', search_all_records, self.instance_obj, self._payload_search_hs)
+        metrics.incr('api_calls')
         self.logger.info(f'... Obtained {len(instances_json)} instances to create certifications for.\n')
+        # Records that were just reconciled may still show up until Hubspot reindexes them
+        instances_json = [instance for instance in instances_json if int(instance['id']) not in reconciled]
+        instances_json = completion_order(instances_json, load_checkpoint(self.session, 'linkedinbadge'))
+
+        self.issue_certificates(instances_json)
+
+        self.logger.info(f'\n--- END LINKEDIN CERTIFICATIONS CREATION ---\n')
+
+    def issue_for_records(self, hs_ids):
+        """
+        Issue the certificates of specific records straight away, e.g. when a webhook says they
+        were just completed. Records that do not match the search (not completed, survey not
+        done or already have a badge) are left alone.
+
+        Args:
+            hs_ids (list): Hubspot ids of the records
+
+        Returns:
+            issued (int): number of records updated on Hubspot
+        """
+        payload = copy.deepcopy(self._payload_search_hs)
+        payload['filterGroups'][0]['filters'].append({'propertyName': 'hs_object_id',
+                                                      'operator': 'IN',
+                                                      'values': [str(hs_id) for hs_id in hs_ids]})
+        instances_json = guarded_call('hubspot', search_all_records, self.instance_obj, payload)
+        metrics.incr('api_calls')
+        return self.issue_certificates(instances_json)
+
+    def issue_certificates(self, instances_json):
+        """
+        Gather the cert urls and Linkedin Badge url of the given Hubspot records and update them on
+        Hubspot in one batch
+
+        Args:
+            instances_json (list): Hubspot records as returned by the search
+
+        Returns:
+            issued (int): number of records updated on Hubspot
+        """
+        self.update_payload_hs = {'inputs': []}
+
+        retry_queue = RetryQueue(self.session)
+        due_instances = [instance for instance in instances_json if retry_queue.is_due(instance['id'])]
+        if len(due_instances) < len(instances_json):
+            self.logger.info(f'Skipping {len(instances_json) - len(due_instances)} instance(s) that are waiting to be retried.\n')
+            metrics.incr('retry_skipped', len(instances_json) - len(due_instances))
 
         self.logger.info(f'Creating Certifications and LinkedIn URL\n')
-        for instance in instances_json:
+        stopped_at = None
+        for i, instance in enumerate(due_instances):
+            if self.budget and not self.budget.allows(RUN_BUDGET_RESERVE):
+                self.logger.warning(f'Run budget of {self.budget.seconds:.0f}s almost used up, leaving the remaining '
+                                    f'{len(due_instances) - i} instance(s) for the next run.')
+                metrics.incr('budget_deferred', len(due_instances) - i)
+                stopped_at = i
+                break
+            if self.leases:
+                self.leases.heartbeat()
+                if not self.leases.claim(instance['id']):
+                    # Another worker is on it
+                    metrics.incr('lease_skipped')
+                    continue
             try:
                 record = PdfGenAPILinkedIn(instance, self.isodate, self.engine, self.session)
-                record.gather_urls()
+                profiler.wrap('gather_urls', record.gather_urls)()
                 self.update_payload_hs['inputs'].append({'id': instance['id'], 
-                                                        'properties': record.urls | {'certificate_issue_year': int(self.isodate.year), 
-                                                                                    'certificate_issue_month': int(self.isodate.month),
-                                                                                    'certificate_issue_date': self.hs_date}})
+                                                        'properties': record.urls | self.issue_properties(record.issued_on)})
+                metrics.incr('records_processed')
+            except CircuitOpenError as c:
+                self.logger.warning(f'{c} Skipping the remaining {len(due_instances) - i} instance(s) until the next run.')
+                metrics.incr('errors')
+                break
             except SQLAlchemyError as s:
                 self.logger.error(s, exc_info=True)
+                metrics.incr('errors')
                 self.session.rollback()
+                retry_queue.record_failure(instance['id'], s)
                 continue
             except Exception as e:
                 self.logger.error(e, exc_info=True)
+                metrics.incr('errors')
+                retry_queue.record_failure(instance['id'], e)
                 continue
         self.logger.info(f'\nUrls for {len(self.update_payload_hs["inputs"])} instance(s) have been created.\n')
+        if self.budget:
+            remaining = [] if stopped_at is None else [instance['id'] for instance in due_instances[stopped_at:]]
+            save_checkpoint(self.session, 'linkedinbadge', len(self.update_payload_hs['inputs']), remaining)
 
-        add_linkedin_badge = UpdateRecordsHandler(self.instance_obj)
-        add_linkedin_badge.dispatch(self.update_payload_hs)
+        if self.update_payload_hs['inputs']:
+            hs_ids = [record['id'] for record in self.update_payload_hs['inputs']]
+            add_linkedin_badge = UpdateRecordsHandler(self.instance_obj)
+            try:
+                guarded_call('hubspot', add_linkedin_badge.dispatch, self.update_payload_hs)
+            except CircuitOpenError:
+                # Not the records' fault, they are reconciled on the next run
+                raise
+            except Exception as e:
+                # Only done once Hubspot has the urls, so a failed update is retried through the queue
+                for hs_id in hs_ids:
+                    retry_queue.record_failure(hs_id, e)
+                raise
+            metrics.incr('api_calls')
+            mark_synced(self.session, hs_ids)
+            for hs_id in hs_ids:
+                retry_queue.record_success(hs_id)
+        if self.leases:
+            self.leases.release()
+        return len(self.update_payload_hs['inputs'])
 
-        self.session.close()
-        self.engine.dispose()
+    def _reconcile(self):
+        """
+        Push certificates whose urls were all produced during an earlier run but never made it to
+        Hubspot (e.g. the batch update failed), in one batch update and without rendering them
+        again.
 
-        self.logger.info(f'\n--- END LINKEDIN CERTIFICATIONS CREATION ---\n')
+        Returns:
+            reconciled (set): Hubspot ids of the records that were pushed
+        """
+        entries = pending_sync(self.session)
+        if self.leases:
+            # Leave certificates that another worker is still working on to that worker
+            entries = [entry for entry in entries if self.leases.claim(entry.hs_instance_id)]
+        if not entries:
+            return set()
+        self.logger.info(f'Reconciling {len(entries)} certificate(s) that were created but not added to Hubspot...')
+        payload = {'inputs': [{'id': str(entry.hs_instance_id),
+                               'properties': hs_properties(entry) | self.issue_properties(entry.issued_on)}
+                              for entry in entries]}
+        try:
+            reconcile_records = UpdateRecordsHandler(self.instance_obj)
+            guarded_call('hubspot', reconcile_records.dispatch, payload)
+            metrics.incr('api_calls')
+        except Exception as e:
+            self.logger.error(e, exc_info=True)
+            metrics.incr('errors')
+            return set()
+        reconciled = {entry.hs_instance_id for entry in entries}
+        mark_synced(self.session, reconciled)
+        # Records whose batch update failed were queued for a retry, Hubspot has their urls now
+        retry_queue = RetryQueue(self.session)
+        for hs_id in reconciled:
+            retry_queue.record_success(hs_id)
+        if self.leases:
+            self.leases.release(reconciled)
+        metrics.incr('records_reconciled', len(reconciled))
+        self.logger.info(f'... {len(reconciled)} certificate(s) reconciled.\n')
+        return reconciled
+
+    def issue_properties(self, issued_on):
+        """Hubspot properties with the issue date of a certificate
+
+        Args:
+            issued_on (date): date the certificate was issued
+
+        Returns:
+            properties (dict): issue year, month and date (midnight in unix epoch milliseconds)
+        """
+        issued_on = issued_on or self.isodate
+        midnight = datetime.datetime.combine(issued_on, datetime.datetime.min.time())
+        return {'certificate_issue_year': int(issued_on.year),
+                'certificate_issue_month': int(issued_on.month),
+                'certificate_issue_date': timegm(midnight.timetuple()) * 1000}
 
     def _assign_date(self):
         """Main method to gather the assignment due date and update on Hubspot"""
         self.logger.info(f'\n--- BEGIN ASSIGNMENTMENT DUE DATE CALCULATION ---\n')
 
-        
-        get_appropriate_records = DueDate()
+        if self.budget and not self.budget.allows(DUE_DATE_RESERVE):
+            self.logger.warning('Run budget used up, leaving the due dates for the next run.')
+            self.logger.info(f'\n--- END ASSIGNMENTMENT DUE DATE CALCULATION ({self.isodate}) ---')
+            return
+
+        # Only the due dates that changed since they were last sent are in the payload
+        get_appropriate_records = DueDate(session=self.session)
         get_appropriate_records.calc_assign_due_date()
+        inputs = get_appropriate_records.payload['inputs']
+        # Due dates a budgeted run left go first, in the order they were left, then soonest sessions first
+        resume = {int(hs_id): i for i, hs_id in enumerate(load_checkpoint(self.session, 'assign_date'))}
+        inputs = sorted(inputs, key=lambda record: resume.get(int(record['id']), len(resume)))
         add_assign_due_date = UpdateRecordsHandler(self.instance_obj)
-        add_assign_due_date.dispatch(get_appropriate_records.payload)
+        # Within a budget, update in batches (soonest sessions first) and stop when time runs out
+        batch_size = DUE_DATE_BATCH if self.budget else max(len(inputs), 1)
+        batches = [inputs[i:i + batch_size] for i in range(0, len(inputs), batch_size)]
+        sent = 0
+        for batch in batches:
+            if self.budget and not self.budget.allows(DUE_DATE_RESERVE):
+                self.logger.warning(f'Run budget used up, leaving {len(inputs) - sent} due date(s) for the next run.')
+                metrics.incr('budget_deferred', len(inputs) - sent)
+                break
+            guarded_call('hubspot', add_assign_due_date.dispatch, {'inputs': batch})
+            metrics.incr('api_calls')
+            get_appropriate_records.mark_sent(batch)
+            sent += len(batch)
+        if self.budget:
+            save_checkpoint(self.session, 'assign_date', sent, [record['id'] for record in inputs[sent:]])
         try:
-            self.logger.info(f'\n{len(get_appropriate_records.payload["inputs"])} due date(s) have been added.\n')
+            self.logger.info(f'\n{sent} due date(s) have been added.\n')
+            metrics.incr('records_processed', sent)
         except Exception as e:
             self.logger.error(e, exc_info=True)
+            metrics.incr('errors')
 
         self.logger.info(f'\n--- END ASSIGNMENTMENT DUE DATE CALCULATION ({self.isodate}) ---')
 
+
+def main():
+    parser = argparse.ArgumentParser(description='Create the certificates and due dates and update them on Hubspot.')
+    parser.add_argument('--budget', type=float, default=RUN_BUDGET,
+                        help='seconds the run may take, 0 for no limit (defaults to RUN_BUDGET)')
+    traffic = parser.add_mutually_exclusive_group()
+    traffic.add_argument('--record', metavar='PATH', help='record every HTTP request of the run to PATH')
+    traffic.add_argument('--replay', metavar='PATH', help='answer every HTTP request from the recording at PATH')
+    parser.add_argument('--replay-speed', type=float, default=1.0,
+                        help='factor applied to the recorded response times, 0 to answer straight away')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile every stage and write the profiles next to the run log (defaults to RUN_PROFILE)')
+    args = parser.parse_args()
+    if args.replay and not os.getenv('CERT_DB_URL'):
+        parser.error('--replay needs CERT_DB_URL set to a scratch database, so the ledger is left alone')
+
+    if args.profile:
+        profiler.enable()
+
+    create_tables()
+    http = HttpRecorder() if args.record else HttpReplayer(args.replay, args.replay_speed) if args.replay else None
+    if http:
+        http.install()
+    try:
+        daily_run = LinkedInBadgeDueDate()
+        daily_run.run(budget=args.budget)
+    finally:
+        if http:
+            http.uninstall()
+        if args.record:
+            http.save(args.record)
+
+
 if __name__ == '__main__':
-    daily_run = LinkedInBadgeDueDate()
-    daily_run.run()
+    main()
@@ -0,0 +1,121 @@
+"""
+Module to keep a run within a wall-clock budget. The cronjob skips a run while the previous one is
+still going (flock -n), so a run that overruns the hour makes the backlog grow. With RUN_BUDGET
+set, the run works through the records in priority order (oldest completions first, due dates of
+the soonest sessions first), stops before the budget is used up and stores where it stopped in the
+run_checkpoint table. The next run starts with the records that were left.
+
+Usage:
+    python run_budget.py status
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import os
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from models import RunCheckpoint, SQLITE_DB, create_tables
+
+logger = logging.getLogger(F'LinkedInAssignDueDateUpdate.{__name__}')
+
+RUN_BUDGET = float(os.getenv('RUN_BUDGET', 0)) # Seconds, 0 for no budget
+# Seconds kept back at the end of the certificates for their Hubspot update, the due dates and
+# saving the run
+RUN_BUDGET_RESERVE = float(os.getenv('RUN_BUDGET_RESERVE', 120))
+# Seconds kept back at the end of the due dates for the last Hubspot update and saving the run
+DUE_DATE_RESERVE = 15
+# Due dates updated on Hubspot per request when running within a budget
+DUE_DATE_BATCH = 100
+
+
+class RunBudget:
+    def __init__(self, seconds):
+        """
+        Class to keep track of the wall-clock time left in a run
+
+        Args:
+            seconds (float): budget of the run, starting now
+        """
+        self.seconds = seconds
+        self._deadline = time.monotonic() + seconds
+
+    def remaining(self):
+        """Seconds left in the budget"""
+        return self._deadline - time.monotonic()
+
+    def allows(self, reserve=0):
+        """Whether more than `reserve` seconds are left, i.e. there is time to start more work"""
+        return self.remaining() > reserve
+
+
+def completion_order(instances_json, resume_ids=()):
+    """Order Hubspot records so the longest waiting students get their certificate first
+
+    Args:
+        instances_json (list): Hubspot records as returned by the search
+        resume_ids (list, optional): ids left by the last run, put first in their own order
+
+    Returns:
+        instances_json (list): the records in priority order
+    """
+    resume = {int(hs_id): i for i, hs_id in enumerate(resume_ids)}
+    # The last update of a record is when the survey or the course was completed, the search only
+    # returns records that do not have a certificate yet
+    return sorted(instances_json, key=lambda instance: (resume.get(int(instance['id']), len(resume)),
+                                                        instance.get('updatedAt') or ''))
+
+
+def load_checkpoint(session, stage):
+    """Hubspot ids a previous run left in a stage, in priority order"""
+    checkpoint = session.query(RunCheckpoint).filter_by(stage=stage).first()
+    if checkpoint is None or not checkpoint.remaining:
+        return []
+    logger.info(f'The run of {checkpoint.stopped_at:%Y-%m-%d %H:%M} stopped "{stage}" with '
+                f'{len(json.loads(checkpoint.remaining))} record(s) left, starting with those.')
+    return json.loads(checkpoint.remaining)
+
+
+def save_checkpoint(session, stage, done, remaining_ids):
+    """Store where a stage stopped, or clear the checkpoint when nothing is left
+
+    Args:
+        session: SQLAlchemy session bound to the local database
+        stage (str): name of the stage
+        done (int): records finished before stopping
+        remaining_ids (list): Hubspot ids left, in priority order
+    """
+    if not remaining_ids:
+        session.query(RunCheckpoint).filter_by(stage=stage).delete()
+    else:
+        session.merge(RunCheckpoint(stage=stage, stopped_at=datetime.datetime.utcnow(), done=done,
+                                    remaining=json.dumps([int(hs_id) for hs_id in remaining_ids])))
+    session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Show where time-budgeted runs stopped.')
+    parser.add_argument('command', choices=['status'])
+    parser.parse_args()
+
+    create_tables()
+    engine = create_engine(SQLITE_DB)
+    session = sessionmaker(bind=engine)()
+    try:
+        checkpoints = session.query(RunCheckpoint).order_by(RunCheckpoint.stage).all()
+        if not checkpoints:
+            print('The last run finished every stage.')
+        for checkpoint in checkpoints:
+            print(f'{checkpoint.stage}: stopped {checkpoint.stopped_at:%Y-%m-%d %H:%M:%S} after '
+                  f'{checkpoint.done} record(s), {len(json.loads(checkpoint.remaining))} left')
+    finally:
+        session.close()
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,170 @@
+"""
+Module to collect a summary of every run (records processed, wall time, per-stage time, errors and
+API calls), store it in the local SQLite database and report on trends between runs.
+
+Usage:
+    python run_metrics.py trends [--last 20]
+    python run_metrics.py regressions [--window 10] [--threshold 0.75]
+"""
+
+import argparse
+import datetime
+import json
+import logging
+import statistics
+import threading
+import time
+
+from collections import Counter
+from contextlib import contextmanager
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from models import RunMetric, SQLITE_DB, create_tables
+
+logger = logging.getLogger(F'LinkedInAssignDueDateUpdate.{__name__}')
+
+
+class RunMetrics:
+    def __init__(self):
+        """
+        Class to collect counters and stage timings during a run. Modules increment the shared
+        `metrics` instance below so the counts can be saved at the end of the run.
+        """
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Start collecting a new run"""
+        with self._lock:
+            self.started_at = datetime.datetime.utcnow()
+            self._start = time.perf_counter()
+            self.stage_times = {}
+            self.counters = Counter()
+
+    def incr(self, name, amount=1):
+        """Increment a counter, e.g. 'api_calls', 'errors' or 'records_processed'"""
+        with self._lock:
+            self.counters[name] += amount
+
+    @contextmanager
+    def stage(self, name):
+        """Context manager adding the wall time of the block to the named stage"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.stage_times[name] = self.stage_times.get(name, 0) + elapsed
+
+    def save(self, session):
+        """Persist the collected metrics as one row of the run_metrics table
+
+        Args:
+            session: SQLAlchemy session bound to the local database
+
+        Returns:
+            row (RunMetric): the saved row
+        """
+        with self._lock:
+            counters = dict(self.counters)
+            row = RunMetric(
+                started_at=self.started_at,
+                wall_time=time.perf_counter() - self._start,
+                records_processed=counters.pop('records_processed', 0),
+                errors=counters.pop('errors', 0),
+                api_calls=counters.pop('api_calls', 0),
+                stage_times=json.dumps(self.stage_times),
+                counters=json.dumps(counters)
+            )
+        session.add(row)
+        session.commit()
+        return row
+
+
+# Shared collector for the current run
+metrics = RunMetrics()
+
+
+def throughput(row):
+    """Records processed per second for a run, None when the run did no work"""
+    if not row.wall_time or not row.records_processed:
+        return None
+    return row.records_processed / row.wall_time
+
+
+def find_regressions(rows, window=10, threshold=0.75):
+    """Flag runs whose throughput drops below a rolling baseline of the runs before it
+
+    Args:
+        rows (list): RunMetric rows ordered from oldest to newest
+        window (int, optional): Number of previous runs the baseline is the median of.
+            Defaults to 10.
+        threshold (float, optional): Fraction of the baseline under which a run is flagged.
+            Defaults to 0.75.
+
+    Returns:
+        regressions (dict): {run id: baseline throughput} for every flagged run
+    """
+    regressions = {}
+    history = []
+    for row in rows:
+        curr = throughput(row)
+        if curr is None:
+            continue
+        if len(history) >= min(window, 3):
+            baseline = statistics.median(history[-window:])
+            if curr < baseline * threshold:
+                regressions[row.id] = baseline
+        history.append(curr)
+    return regressions
+
+
+def load_runs(session, last=None):
+    """Get the saved runs ordered from oldest to newest, optionally only the last n"""
+    query = session.query(RunMetric).order_by(RunMetric.started_at.desc())
+    if last:
+        query = query.limit(last)
+    return list(reversed(query.all()))
+
+
+def print_runs(rows, regressions):
+    print(f'{"STARTED (UTC)":<20}{"RECORDS":>9}{"WALL (S)":>10}{"REC/S":>8}{"ERRORS":>8}{"API":>6}  STAGES')
+    for row in rows:
+        stages = ', '.join(f'{name}={secs:.1f}s' for name, secs in json.loads(row.stage_times or '{}').items())
+        rate = throughput(row)
+        flag = f'  <-- below baseline of {regressions[row.id]:.2f} rec/s' if row.id in regressions else ''
+        print(f'{row.started_at:%Y-%m-%d %H:%M:%S} '
+              f'{row.records_processed:>9}{row.wall_time:>10.1f}{(rate or 0):>8.2f}{row.errors:>8}{row.api_calls:>6}  '
+              f'{stages}{flag}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Show run trends and flag slow runs.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    trends = subparsers.add_parser('trends', help='Show the most recent runs')
+    trends.add_argument('--last', type=int, default=20)
+    regressions = subparsers.add_parser('regressions', help='Only show runs below the rolling baseline')
+    for sub in (trends, regressions):
+        sub.add_argument('--window', type=int, default=10, help='Number of runs in the rolling baseline')
+        sub.add_argument('--threshold', type=float, default=0.75, help='Fraction of the baseline to flag below')
+    args = parser.parse_args()
+
+    create_tables()
+    engine = create_engine(SQLITE_DB)
+    session = sessionmaker(bind=engine)()
+    try:
+        rows = load_runs(session, getattr(args, 'last', None))
+        flagged = find_regressions(rows, args.window, args.threshold)
+        if args.command == 'regressions':
+            rows = [row for row in rows if row.id in flagged]
+        print_runs(rows, flagged)
+    finally:
+        session.close()
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,174 @@
+"""
+Module to profile the stages of a run without editing the code. With --profile (or RUN_PROFILE=1)
+every stage is profiled by cProfile and sampled every PROFILE_INTERVAL seconds, and the run writes
+next to its log, for every stage:
+    {timestamp}_profile_{stage}.pstats     (python -m pstats, snakeviz, ...)
+    {timestamp}_profile_{stage}.collapsed  (flamegraph.pl, speedscope, ...)
+
+A stage run inside another stage (e.g. gather_urls inside linkedinbadge) has its own pstats, which
+the outer stage's pstats leave out, while the outer stage's collapsed stacks include it. When
+profiling is off, wrap() hands back the function untouched so nothing is added to the run.
+"""
+
+import cProfile
+import datetime
+import logging
+import os
+import pstats
+import sys
+import threading
+
+from collections import Counter, defaultdict
+
+from dotenv import load_dotenv
+
+from logger import get_log_dir
+
+load_dotenv()
+
+logger = logging.getLogger(F'LinkedInAssignDueDateUpdate.{__name__}')
+
+RUN_PROFILE = os.getenv('RUN_PROFILE', '').lower() in ('1', 'true', 'yes')
+PROFILE_INTERVAL = float(os.getenv('PROFILE_INTERVAL', 0.005)) # Seconds between stack samples
+
+
+class RunProfiler:
+    def __init__(self, enabled=RUN_PROFILE, interval=PROFILE_INTERVAL):
+        """
+        Profiles the stages wrapped with wrap(). Modules use the shared `profiler` instance below.
+
+        Args:
+            enabled (bool, optional): Defaults to RUN_PROFILE.
+            interval (float, optional): seconds between stack samples. Defaults to PROFILE_INTERVAL.
+        """
+        self.enabled = enabled
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+        self._reset()
+
+    def _reset(self):
+        self._local = threading.local() # Stack of stages and cProfiles of the current thread
+        self._profiles = defaultdict(list) # Stage name -> cProfile of every thread it ran on
+        self._samples = defaultdict(Counter) # Stage name -> collapsed stack -> samples
+        self._active = {} # Thread id -> names of the stages the thread is in
+        self._cprofile_failed = False
+
+    def enable(self):
+        self.enabled = True
+
+    def wrap(self, name, func):
+        """Profile every call of func as the named stage. Returns func itself when profiling is off."""
+        if not self.enabled:
+            return func
+
+        def profiled(*args, **kwargs):
+            self._enter(name)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._exit()
+        return profiled
+
+    def _thread_profile(self, name):
+        """cProfile of the named stage for the current thread"""
+        profiles = getattr(self._local, 'profiles', None)
+        if profiles is None:
+            profiles = self._local.profiles = {}
+        if name not in profiles:
+            profiles[name] = cProfile.Profile()
+            with self._lock:
+                self._profiles[name].append(profiles[name])
+        return profiles[name]
+
+    def _enable(self, profile):
+        try:
+            profile.enable()
+            return True
+        except ValueError:
+            # Python 3.12+ only allows one cProfile at a time, the stage keeps its sampled stacks
+            if not self._cprofile_failed:
+                self._cprofile_failed = True
+                logger.warning('Another profiler is already active, stages running alongside it only get sampled stacks.')
+            return False
+
+    def _enter(self, name):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        if stack and stack[-1][1]:
+            stack[-1][1].disable()
+        profile = self._thread_profile(name)
+        stack.append((name, profile if self._enable(profile) else None))
+        self._active[threading.get_ident()] = tuple(entry[0] for entry in stack)
+
+    def _exit(self):
+        stack = self._local.stack
+        _, profile = stack.pop()
+        if profile:
+            profile.disable()
+        if stack:
+            self._active[threading.get_ident()] = tuple(entry[0] for entry in stack)
+            if stack[-1][1] and not self._enable(stack[-1][1]):
+                stack[-1] = (stack[-1][0], None)
+        else:
+            self._active.pop(threading.get_ident(), None)
+
+    def start(self):
+        """Start sampling the stages of a new run"""
+        if not self.enabled:
+            return
+        self._reset()
+        self._started_at = datetime.datetime.utcnow()
+        self._stop.clear()
+        self._sampler = threading.Thread(target=self._sample, name='run-profiler', daemon=True)
+        self._sampler.start()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            for ident, names in list(self._active.items()):
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                collapsed = ';'.join(reversed(stack))
+                for name in names:
+                    self._samples[name][collapsed] += 1
+
+    def stop(self):
+        """
+        Stop sampling and write the profiles of every stage next to the run log
+
+        Returns:
+            paths (list): files written
+        """
+        if not self.enabled or self._sampler is None:
+            return []
+        self._stop.set()
+        self._sampler.join()
+        self._sampler = None
+
+        prefix = os.path.join(get_log_dir(), f'{self._started_at.isoformat()}_profile_')
+        paths = []
+        for name in sorted(set(self._profiles) | set(self._samples)):
+            # No cProfile data when another profiler was active all along
+            profiles = [profile for profile in self._profiles[name] if profile.getstats()]
+            if profiles:
+                pstats.Stats(*profiles).dump_stats(f'{prefix}{name}.pstats')
+                paths.append(f'{prefix}{name}.pstats')
+            if self._samples[name]:
+                with open(f'{prefix}{name}.collapsed', 'w') as f:
+                    for stack, count in self._samples[name].most_common():
+                        f.write(f'{stack} {count}\n')
+                paths.append(f'{prefix}{name}.collapsed')
+        logger.info(f'Wrote {len(paths)} profile file(s) to {get_log_dir()}.')
+        return paths
+
+
+profiler = RunProfiler()
@@ -0,0 +1,93 @@
+"""
+Module to run the stages of a run as a small graph. Every stage declares the stages it depends
+on; stages whose dependencies are done run at the same time on their own thread, so e.g. the due
+dates are calculated while the certificates are being made. The wall time of every stage goes into
+the run metrics.
+"""
+
+import logging
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from run_metrics import metrics
+
+logger = logging.getLogger(F'LinkedInAssignDueDateUpdate.{__name__}')
+
+
+class StageSkipped(Exception):
+    """Error of a stage that did not run because a stage it depends on failed"""
+
+
+class Stage:
+    def __init__(self, name, func, depends_on=()):
+        """
+        One stage of a run
+
+        Args:
+            name (str): name of the stage, also used for its wall time in the run metrics
+            func (callable): called without arguments on a worker thread, its return value is kept
+            depends_on (tuple, optional): names of the stages that have to finish first
+        """
+        self.name = name
+        self.func = func
+        self.depends_on = tuple(depends_on)
+
+
+def run_stages(stages):
+    """Run stages as soon as their dependencies are done. A stage that raises is logged and the
+    stages depending on it are skipped, the other stages carry on.
+
+    Args:
+        stages (list): Stage objects, with unique names and dependencies among them
+
+    Returns:
+        results, errors (dict): return value of every stage that finished, exception of every
+            stage that failed, by name
+    """
+    names = {stage.name for stage in stages}
+    for stage in stages:
+        unknown = set(stage.depends_on) - names
+        if unknown:
+            raise ValueError(f'Stage "{stage.name}" depends on unknown stage(s) {sorted(unknown)}.')
+
+    def timed(stage):
+        start = time.perf_counter()
+        with metrics.stage(stage.name):
+            result = stage.func()
+        logger.info(f'Stage "{stage.name}" took {time.perf_counter() - start:.1f}s.')
+        return result
+
+    results, errors = {}, {}
+    waiting = list(stages)
+    running = {}
+    with ThreadPoolExecutor(max_workers=len(stages) or 1, thread_name_prefix='stage') as executor:
+        while waiting or running:
+            # Go over the waiting stages until nothing changes, skipping a stage can skip others
+            changed = True
+            while changed:
+                changed = False
+                for stage in list(waiting):
+                    if any(dep in errors for dep in stage.depends_on):
+                        logger.warning(f'Skipping stage "{stage.name}", a stage it depends on failed.')
+                        errors[stage.name] = StageSkipped(f'Stage "{stage.name}" depends on a failed stage.')
+                    elif all(dep in results for dep in stage.depends_on):
+                        running[executor.submit(timed, stage)] = stage
+                    else:
+                        continue
+                    waiting.remove(stage)
+                    changed = True
+            if not waiting and not running:
+                break
+            if not running:
+                # Only possible with a dependency cycle
+                raise ValueError(f'Stages {[stage.name for stage in waiting]} depend on each other.')
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                try:
+                    results[stage.name] = future.result()
+                except Exception as e:
+                    logger.error(f'Stage "{stage.name}" failed: {e}', exc_info=e)
+                    errors[stage.name] = e
+    return results, errors
@@ -0,0 +1,219 @@
+"""
+Module for write-behind uploads of certificates to S3. With UPLOAD_MODE=write_behind in the .env
+file, a rendered certificate is written to the local spool folder and queued in the
+pending_upload table, and its S3 url (which only depends on the bucket and the certificate name)
+is used right away, so the Hubspot update does not wait on S3. A background thread drains the
+queue while the run goes on and every upload is verified against the size of the spooled file
+before the file is removed. A failed upload is retried after UPLOAD_BASE_DELAY * 2 ** (attempts - 1)
+seconds (at most UPLOAD_MAX_DELAY), and dead-lettered after UPLOAD_MAX_ATTEMPTS failures.
+
+Usage:
+    python upload_queue.py drain
+    python upload_queue.py list [--dead]
+    python upload_queue.py requeue <name>
+"""
+
+import argparse
+import base64
+import datetime
+import hashlib
+import logging
+import os
+import threading
+
+from sqlalchemy import create_engine, or_
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from aws_bucket import cert_url, upload_pdf, uploaded_size
+from circuit_breaker import CircuitOpenError
+from ledger import mark_uploaded
+from models import PendingUpload, SQLITE_DB, create_tables
+from pdf_optimizer import optimize_pdf
+
+logger = logging.getLogger(F'LinkedInAssignDueDateUpdate.{__name__}')
+
+WRITE_BEHIND = os.getenv('UPLOAD_MODE', 'direct').lower() == 'write_behind'
+SPOOL_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'spool')
+DRAIN_INTERVAL = float(os.getenv('UPLOAD_DRAIN_INTERVAL', 1)) # Seconds between checks of the queue
+MAX_ATTEMPTS = int(os.getenv('UPLOAD_MAX_ATTEMPTS', 8))
+BASE_DELAY = int(os.getenv('UPLOAD_BASE_DELAY', 5)) # Seconds
+MAX_DELAY = int(os.getenv('UPLOAD_MAX_DELAY', 3600)) # Seconds
+
+PENDING = 'pending'
+DEAD = 'dead'
+
+
+def enqueue_upload(session, cert_base64, name, hs_instance_id=None):
+    """Spool a certificate for a later upload and return the url it will have
+
+    Args:
+        session: SQLAlchemy session bound to the local database
+        cert_base64: base64 of certificate to be added to AWS
+        name (str): name of the certificate
+        hs_instance_id (int, optional): record whose ledger entry is marked uploaded once every
+            certificate of the record was uploaded. Defaults to None.
+
+    Returns:
+        url (str): url to the pdf of the certificate once uploaded
+    """
+    body = base64.b64decode(cert_base64)
+    os.makedirs(SPOOL_DIR, exist_ok=True)
+    path = os.path.join(SPOOL_DIR, f'{hashlib.sha256(name.encode()).hexdigest()}.pdf')
+    # Write to a temporary file first so a crash never leaves half a pdf in the spool
+    with open(f'{path}.tmp', 'wb') as f:
+        f.write(body)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(f'{path}.tmp', path)
+    session.merge(PendingUpload(name=name, hs_instance_id=hs_instance_id, path=path, size=len(body), attempts=0, status=PENDING,
+                                next_attempt_at=None, created_at=datetime.datetime.utcnow()))
+    session.commit()
+    return cert_url(name)
+
+
+def has_pending_uploads(session, hs_instance_id):
+    """Whether certificates of a record are still waiting in the queue, dead-lettered ones included"""
+    return session.query(PendingUpload.name).filter_by(hs_instance_id=int(hs_instance_id)).first() is not None
+
+
+def due_uploads(session, now=None):
+    """Queued certificates that are not dead-lettered and not backing off"""
+    now = now or datetime.datetime.utcnow()
+    return session.query(PendingUpload) \
+        .filter(or_(PendingUpload.status.is_(None), PendingUpload.status == PENDING)) \
+        .filter(or_(PendingUpload.next_attempt_at.is_(None), PendingUpload.next_attempt_at <= now)) \
+        .order_by(PendingUpload.created_at)
+
+
+def record_upload_failure(session, pending, error):
+    """Add a failed attempt to a queued certificate and back it off, or dead-letter it"""
+    now = datetime.datetime.utcnow()
+    pending.attempts = (pending.attempts or 0) + 1
+    pending.last_error = repr(error)[:1000]
+    if pending.attempts >= MAX_ATTEMPTS:
+        pending.status = DEAD
+        logger.error(f'Upload of "{pending.name}" failed {pending.attempts} times and was dead-lettered. '
+                     f'Requeue it with "python upload_queue.py requeue \'{pending.name}\'" once fixed.')
+    else:
+        delay = min(MAX_DELAY, BASE_DELAY * 2 ** (pending.attempts - 1))
+        pending.next_attempt_at = now + datetime.timedelta(seconds=delay)
+    session.commit()
+
+
+def drain_uploads(session):
+    """Upload and verify every certificate in the queue that is due
+
+    Args:
+        session: SQLAlchemy session bound to the local database
+
+    Returns:
+        uploaded, failed (int): number of certificates uploaded and failed
+    """
+    uploaded = failed = 0
+    for pending in due_uploads(session).all():
+        try:
+            with open(pending.path, 'rb') as f:
+                body = f.read()
+            if len(body) != pending.size:
+                raise RuntimeError(f'Spooled "{pending.name}" is {len(body)} bytes instead of {pending.size}.')
+            # Optimized here rather than when spooled, so the run never waits on the pdf workers
+            body = optimize_pdf(body)
+            if upload_pdf(body, pending.name) is None:
+                raise RuntimeError(f'Upload of "{pending.name}" to S3 failed.')
+            size = uploaded_size(pending.name)
+            if size != len(body):
+                raise RuntimeError(f'Uploaded "{pending.name}" is {size} bytes instead of {len(body)}.')
+        except CircuitOpenError as c:
+            logger.warning(f'{c} {session.query(PendingUpload).count()} upload(s) left for the next run.')
+            break
+        except Exception as e:
+            logger.error(e, exc_info=True)
+            record_upload_failure(session, pending, e)
+            failed += 1
+            continue
+        session.delete(pending)
+        session.commit()
+        os.remove(pending.path)
+        if pending.hs_instance_id and not has_pending_uploads(session, pending.hs_instance_id):
+            mark_uploaded(session, pending.hs_instance_id)
+        uploaded += 1
+    return uploaded, failed
+
+
+class UploadDrainer(threading.Thread):
+    def __init__(self, engine):
+        """
+        Background thread draining the upload queue while the run goes on. Call stop() to drain
+        whatever is left and wait for the thread.
+
+        Args:
+            engine: SQLAlchemy engine of the local database
+        """
+        super().__init__(name='upload-drainer', daemon=True)
+        self.session = scoped_session(sessionmaker(bind=engine))
+        self._stop_event = threading.Event()
+        self.uploaded = self.failed = 0
+
+    def run(self):
+        while True:
+            stopping = self._stop_event.wait(DRAIN_INTERVAL)
+            try:
+                uploaded, failed = drain_uploads(self.session)
+                self.uploaded += uploaded
+                self.failed += failed
+            except Exception as e:
+                logger.error(e, exc_info=True)
+                self.session.rollback()
+            if stopping:
+                break
+        self.session.remove()
+
+    def stop(self):
+        """Drain the rest of the queue and wait for the thread to finish"""
+        self._stop_event.set()
+        self.join()
+        logger.info(f'{self.uploaded} certificate(s) uploaded to S3 in the background, {self.failed} failed.')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Work with the write-behind S3 upload queue.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('drain', help='Upload the certificates that are due')
+    list_parser = subparsers.add_parser('list', help='List the queued certificates')
+    list_parser.add_argument('--dead', action='store_true', help='Only list dead-lettered certificates')
+    requeue_parser = subparsers.add_parser('requeue', help='Retry a dead-lettered certificate on the next drain')
+    requeue_parser.add_argument('name')
+    args = parser.parse_args()
+
+    create_tables()
+    engine = create_engine(SQLITE_DB)
+    session = sessionmaker(bind=engine)()
+    try:
+        if args.command == 'drain':
+            uploaded, failed = drain_uploads(session)
+            print(f'{uploaded} certificate(s) uploaded, {failed} failed.')
+        elif args.command == 'list':
+            query = session.query(PendingUpload).order_by(PendingUpload.created_at)
+            if args.dead:
+                query = query.filter_by(status=DEAD)
+            for pending in query.all():
+                print(f'{pending.created_at:%Y-%m-%d %H:%M:%S}  {pending.size:>8} bytes  {pending.status or PENDING:<8}'
+                      f'{pending.attempts} attempt(s)  next: {pending.next_attempt_at or "-"}  {pending.name}'
+                      + (f'  last error: {pending.last_error}' if pending.last_error else ''))
+        else:
+            pending = session.query(PendingUpload).filter_by(name=args.name).first()
+            if pending is None:
+                print(f'"{args.name}" is not in the upload queue.')
+                return
+            pending.status = PENDING
+            pending.attempts = 0
+            pending.next_attempt_at = None
+            session.commit()
+            print(f'"{args.name}" will be uploaded on the next drain.')
+    finally:
+        session.close()
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
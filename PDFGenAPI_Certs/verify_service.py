@@ -0,0 +1,198 @@
+"""
+Module to verify certificates. Employers who open a LinkedIn badge see the cert id of the
+certificate (nnn-nnnnn-nn); this service looks it up in the ledger (cert_id_history, keyed on the
+cert id) and answers with the Hubspot record, course, issue date and url of the certificate,
+without calling Hubspot. Certificates that were looked up are kept in an LRU cache of
+VERIFY_CACHE_SIZE entries. Unknown cert ids are not cached, so a certificate can be verified as
+soon as it is issued.
+
+Usage:
+    python verify_service.py [--host 127.0.0.1] [--port 8082]
+
+    GET /verify/123-45678-90  or  GET /verify?certId=123-45678-90
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import threading
+
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from dotenv import load_dotenv
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from ledger import SYNCED, UPLOADED, format_cert_id
+from models import CertIdHistory, SQLITE_DB, create_tables
+
+load_dotenv()
+
+logger = logging.getLogger(F'LinkedInAssignDueDateUpdate.{__name__}')
+
+VERIFY_CACHE_SIZE = int(os.getenv('VERIFY_CACHE_SIZE', 10000))
+
+CERT_ID = re.compile(r'^(\d{3})-?(\d{5})-?(\d{2})$')
+
+
+def parse_cert_id(value):
+    """Cert id as stored in the ledger, None when the value is not a cert id
+
+    Args:
+        value (str): cert id in nnn-nnnnn-nn format, with or without the dashes
+
+    Returns:
+        cert_id (int)
+    """
+    match = CERT_ID.match((value or '').strip())
+    return int(''.join(match.groups())) if match else None
+
+
+class LruCache:
+    def __init__(self, maxsize=VERIFY_CACHE_SIZE):
+        """Thread-safe cache dropping the least recently used entry when it is full"""
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            try:
+                self._entries.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return self._entries[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+class CertVerifier:
+    def __init__(self, engine, cache_size=VERIFY_CACHE_SIZE):
+        """
+        Class to look up certificates in the ledger, through an LRU cache
+
+        Args:
+            engine: SQLAlchemy engine of the local database
+            cache_size (int, optional): certificates to keep in memory. Defaults to VERIFY_CACHE_SIZE.
+        """
+        self.session = scoped_session(sessionmaker(bind=engine))
+        self.cache = LruCache(cache_size)
+
+    def lookup(self, cert_id):
+        """JSON answer for an issued certificate
+
+        Args:
+            cert_id (int): cert id as stored in the ledger
+
+        Returns:
+            body (bytes): JSON of the certificate, None when no certificate was issued with this id
+        """
+        body = self.cache.get(cert_id)
+        if body is not None:
+            return body
+        try:
+            row = self.session.query(CertIdHistory.cert_id, CertIdHistory.hs_instance_id, CertIdHistory.course_name,
+                                     CertIdHistory.issued_on, CertIdHistory.linkedin_certificate_url) \
+                .filter(CertIdHistory.cert_id == cert_id,
+                        CertIdHistory.stage.in_([UPLOADED, SYNCED]),
+                        CertIdHistory.linkedin_certificate_url.isnot(None)) \
+                .first()
+        finally:
+            self.session.remove()
+        if row is None:
+            # Not cached, the certificate may be issued by the next run
+            return None
+        body = json.dumps({
+            'cert_id': format_cert_id(row.cert_id),
+            'valid': True,
+            'hs_instance_id': row.hs_instance_id,
+            'course_name': row.course_name,
+            'issued_on': row.issued_on.isoformat() if row.issued_on else None,
+            'certificate_url': row.linkedin_certificate_url,
+        }).encode()
+        self.cache.put(cert_id, body)
+        return body
+
+
+def make_handler(verifier):
+    """Request handler class answering verification requests with JSON"""
+
+    class VerifyHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1' # Keep connections open, verifications come in bursts
+
+        def _send_json(self, status, body):
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlsplit(self.path)
+            if url.path == '/verify':
+                value = parse_qs(url.query).get('certId', [''])[0]
+            elif url.path.startswith('/verify/'):
+                value = url.path[len('/verify/'):]
+            else:
+                self.send_error(404)
+                return
+            cert_id = parse_cert_id(value)
+            if cert_id is None:
+                self._send_json(400, json.dumps({'error': 'A cert id looks like nnn-nnnnn-nn.'}).encode())
+                return
+            try:
+                body = verifier.lookup(cert_id)
+            except Exception as e:
+                logger.error(e, exc_info=True)
+                self.send_error(503, 'The certificate could not be verified, please try again later.')
+                return
+            if body is None:
+                self._send_json(404, json.dumps({'cert_id': format_cert_id(cert_id), 'valid': False}).encode())
+                return
+            self._send_json(200, body)
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    return VerifyHandler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Verify certificates by their cert id.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8082)
+    parser.add_argument('--cache-size', type=int, default=VERIFY_CACHE_SIZE,
+                        help='certificates to keep in memory (defaults to VERIFY_CACHE_SIZE)')
+    args = parser.parse_args()
+
+    from logger import get_logger
+    get_logger('LinkedInAssignDueDateUpdate')
+
+    create_tables()
+    engine = create_engine(SQLITE_DB)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(CertVerifier(engine, args.cache_size)))
+    server.daemon_threads = True
+    logger.info(f'Verifying certificates on http://{args.host}:{args.port}/verify/')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        engine.dispose()
+
+
+if __name__ == '__main__':
+    main()
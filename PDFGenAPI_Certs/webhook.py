@@ -0,0 +1,289 @@
+"""
+Module with a small HTTP receiver for Hubspot property change webhooks, so a student gets their
+certificate and LinkedIn Badge within seconds of completing the course instead of on the next
+hourly run. The hourly run keeps sweeping up anything the webhooks missed.
+
+Subscribe the Hubspot app to property changes of certificate_checkbox and survey_completed and
+point it at WEBHOOK_PUBLIC_URL (the public url forwarded to this receiver). When HS_CLIENT_SECRET
+is set, requests without a valid v3 signature are rejected.
+
+Usage:
+    python webhook.py serve [--host 127.0.0.1] [--port 8080]
+    python webhook.py sample <hs_object_id> [--url http://127.0.0.1:8080/webhook]
+"""
+
+import argparse
+import base64
+import datetime
+import hashlib
+import hmac
+import json
+import logging
+import os
+import queue
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(F'LinkedInAssignDueDateUpdate.{__name__}')
+
+HS_CLIENT_SECRET = os.getenv('HS_CLIENT_SECRET')
+WEBHOOK_PUBLIC_URL = os.getenv('WEBHOOK_PUBLIC_URL', 'http://127.0.0.1:8080')
+WEBHOOK_PATH = '/webhook'
+# Seconds to gather events before issuing them, so both properties changing at once (or several
+# students finishing together) end up in one batch
+BATCH_WINDOW = float(os.getenv('WEBHOOK_BATCH_WINDOW', 2))
+# Hubspot signatures older than this are rejected
+MAX_SIGNATURE_AGE = 300 # Seconds
+
+WATCHED_PROPERTIES = {'certificate_checkbox', 'survey_completed'}
+
+
+def sign(secret, method, uri, body, timestamp):
+    """Hubspot v3 signature of a request
+
+    Args:
+        secret (str): client secret of the Hubspot app
+        method (str): HTTP method
+        uri (str): full url Hubspot sent the request to
+        body (bytes): body of the request
+        timestamp (str): X-HubSpot-Request-Timestamp header, in milliseconds
+
+    Returns:
+        signature (str): base64 of the HMAC SHA-256
+    """
+    message = f'{method}{uri}'.encode() + body + timestamp.encode()
+    return base64.b64encode(hmac.new(secret.encode(), message, hashlib.sha256).digest()).decode()
+
+
+def valid_signature(headers, method, path, body):
+    """Check the X-HubSpot-Signature-v3 header of a request. Always valid without HS_CLIENT_SECRET."""
+    if not HS_CLIENT_SECRET:
+        return True
+    timestamp = headers.get('X-HubSpot-Request-Timestamp', '')
+    signature = headers.get('X-HubSpot-Signature-v3', '')
+    try:
+        if abs(time.time() - int(timestamp) / 1000) > MAX_SIGNATURE_AGE:
+            return False
+    except ValueError:
+        return False
+    expected = sign(HS_CLIENT_SECRET, method, WEBHOOK_PUBLIC_URL.rstrip('/') + path, body, timestamp)
+    return hmac.compare_digest(expected, signature)
+
+
+def record_ids(events):
+    """Hubspot ids of the records a webhook payload asks to issue a certificate for
+
+    Args:
+        events (list): events of a Hubspot webhook request
+
+    Returns:
+        hs_ids (set): ids of the records where a watched property was set to true
+    """
+    hs_ids = set()
+    for event in events if isinstance(events, list) else [events]:
+        if (event.get('subscriptionType', '').endswith('propertyChange')
+                and event.get('propertyName') in WATCHED_PROPERTIES
+                and str(event.get('propertyValue')).lower() == 'true'
+                and event.get('objectId')):
+            hs_ids.add(int(event['objectId']))
+    return hs_ids
+
+
+class CertificateQueue:
+    def __init__(self, issue, window=BATCH_WINDOW):
+        """
+        Queue of records waiting for their certificate. A single background thread takes the
+        records off the queue in small batches, so webhook requests are answered right away.
+
+        Args:
+            issue (callable): called with a list of Hubspot ids to issue
+            window (float, optional): seconds to gather records into one batch.
+                Defaults to WEBHOOK_BATCH_WINDOW.
+        """
+        self.issue = issue
+        self.window = window
+        self._queue = queue.Queue()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._work, name='certificate-queue', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def put(self, hs_ids):
+        """Queue records, ignoring those already waiting"""
+        with self._lock:
+            for hs_id in hs_ids:
+                if hs_id not in self._pending:
+                    self._pending.add(hs_id)
+                    self._queue.put(hs_id)
+
+    def _take_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        with self._lock:
+            self._pending.difference_update(batch)
+        return batch
+
+    def _work(self):
+        while True:
+            batch = self._take_batch()
+            try:
+                self.issue(batch)
+            except Exception as e:
+                # The hourly run picks these records up again
+                logger.error(e, exc_info=True)
+
+
+def issue_records(hs_ids):
+    """Issue the certificates of the given records with a runner for today's date"""
+    from circuit_breaker import half_open_breakers
+    from run import LinkedInBadgeDueDate
+
+    # Every batch is a new cycle, a provider that failed an earlier batch gets a probe again
+    half_open_breakers()
+    runner = LinkedInBadgeDueDate(isodate=datetime.date.today())
+    start = time.perf_counter()
+    try:
+        issued = runner.issue_for_records(hs_ids)
+        logger.info(f'Webhook: issued {issued} of {len(hs_ids)} queued record(s) in {time.perf_counter() - start:.1f}s.')
+    finally:
+        runner.session.close()
+        runner.engine.dispose()
+
+
+def make_handler(certificate_queue):
+    """Request handler class putting the records of every valid webhook on the queue"""
+
+    class WebhookHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path.split('?')[0] != WEBHOOK_PATH:
+                self.send_error(404)
+                return
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            if not valid_signature(self.headers, 'POST', self.path, body):
+                logger.warning(F'"WEBHOOK": "rejected", "REASON": "invalid signature", "CLIENT": "{self.client_address[0]}"')
+                self.send_error(401)
+                return
+            try:
+                hs_ids = record_ids(json.loads(body or b'[]'))
+            except (ValueError, AttributeError):
+                self.send_error(400)
+                return
+            if hs_ids:
+                logger.info(f'Webhook: queued record(s) {sorted(hs_ids)}.')
+                certificate_queue.put(hs_ids)
+            # Answer straight away, Hubspot retries requests that take longer than 5 seconds
+            self.send_response(204)
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    return WebhookHandler
+
+
+def serve(host='127.0.0.1', port=8080):
+    """Run the webhook receiver until interrupted"""
+    from logger import get_logger
+    from circuit_breaker import load_breakers
+    from models import create_tables
+    from run import LinkedInBadgeDueDate
+    from upload_queue import WRITE_BEHIND, UploadDrainer
+
+    get_logger('LinkedInAssignDueDateUpdate')
+    create_tables()
+    if not HS_CLIENT_SECRET:
+        logger.warning('HS_CLIENT_SECRET is not set, webhook signatures are not checked.')
+    runner = LinkedInBadgeDueDate()
+    load_breakers(runner.session)
+    runner.session.close()
+    runner.engine.dispose()
+
+    # Certificates spooled for a write-behind upload are uploaded straight away, not on the next run
+    drainer = UploadDrainer(runner.engine) if WRITE_BEHIND else None
+    if drainer:
+        drainer.start()
+    certificate_queue = CertificateQueue(issue_records)
+    certificate_queue.start()
+    server = ThreadingHTTPServer((host, port), make_handler(certificate_queue))
+    logger.info(f'Listening for Hubspot webhooks on http://{host}:{port}{WEBHOOK_PATH}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if drainer:
+            drainer.stop()
+
+
+def send_sample(url, hs_object_id, property_name='survey_completed'):
+    """Post a sample Hubspot webhook to a running receiver, signed like Hubspot would
+
+    Args:
+        url (str): url of the receiver
+        hs_object_id (int): Hubspot id of the record
+        property_name (str, optional): property that changed. Defaults to 'survey_completed'.
+
+    Returns:
+        res: response of the receiver
+    """
+    now = int(time.time() * 1000)
+    events = [{
+        'eventId': now,
+        'subscriptionId': 0,
+        'portalId': 0,
+        'appId': 0,
+        'occurredAt': now,
+        'subscriptionType': 'object.propertyChange',
+        'attemptNumber': 0,
+        'objectId': int(hs_object_id),
+        'propertyName': property_name,
+        'propertyValue': 'true',
+        'changeSource': 'CRM_UI'
+    }]
+    body = json.dumps(events).encode()
+    headers = {'Content-Type': 'application/json', 'X-HubSpot-Request-Timestamp': str(now)}
+    if HS_CLIENT_SECRET:
+        headers['X-HubSpot-Signature-v3'] = sign(HS_CLIENT_SECRET, 'POST', WEBHOOK_PUBLIC_URL.rstrip('/') + WEBHOOK_PATH,
+                                                 body, str(now))
+    return requests.post(url, data=body, headers=headers, timeout=10)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Receive Hubspot webhooks and issue certificates right away.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve_parser = subparsers.add_parser('serve', help='Run the webhook receiver')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=8080)
+    sample_parser = subparsers.add_parser('sample', help='Post a sample webhook to a running receiver')
+    sample_parser.add_argument('hs_object_id', type=int)
+    sample_parser.add_argument('--url', default=f'http://127.0.0.1:8080{WEBHOOK_PATH}')
+    sample_parser.add_argument('--property', default='survey_completed', choices=sorted(WATCHED_PROPERTIES))
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args.host, args.port)
+    else:
+        res = send_sample(args.url, args.hs_object_id, args.property)
+        print(f'{res.status_code} {res.reason}')
+
+
+if __name__ == '__main__':
+    main()
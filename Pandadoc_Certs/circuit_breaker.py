@@ -0,0 +1,203 @@
+"""
+Module with a circuit breaker and fail-fast timeouts for every outside provider.
+
+After CIRCUIT_FAILURE_THRESHOLD (default 5) consecutive failures of a provider (timeouts,
+connection errors or 5xx responses) its circuit opens, and every following call fails straight
+away with CircuitOpenError so the run can skip the rest of the work for that provider instead of
+waiting out a timeout for every record. The state is saved at the end of the run; a circuit that
+was open is half-open on the next run, where a single probe call is let through (the other callers
+get CircuitOpenError until it is done): a success closes the circuit again and a failure opens it
+for the rest of that run.
+
+Timeouts (seconds) can be set in the .env file with PROVIDER_TIMEOUT, or per provider with
+e.g. TIMEOUT_PDFGENAPI.
+"""
+
+import datetime
+import logging
+import os
+import threading
+
+from models import ProviderCircuit
+from rate_limiter import get_limiter
+
+logger = logging.getLogger(F'LinkedInAssignDueDateUpdate.{__name__}')
+
+FAILURE_THRESHOLD = int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', 5))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    def __init__(self, provider):
+        """Raised instead of calling a provider whose circuit is open"""
+        self.provider = provider
+        super().__init__(f'Circuit for {provider} is open, skipping the call.')
+
+
+def get_timeout(provider):
+    """Seconds to wait on a provider before giving up on a request
+
+    Args:
+        provider (str): one of 'hubspot', 'pdfgenapi', 'pandadoc' or 's3'
+
+    Returns:
+        timeout (float): TIMEOUT_<PROVIDER>, else PROVIDER_TIMEOUT, else 30
+    """
+    return float(os.getenv(f'TIMEOUT_{provider.upper()}', os.getenv('PROVIDER_TIMEOUT', 30)))
+
+
+def is_provider_failure(obj):
+    """Whether a response or exception means the provider itself is failing. Client errors (4xx)
+    and throttling are not failures of the provider.
+
+    Args:
+        obj: requests response, exception raised by a client, or anything else a client returns
+
+    Returns:
+        (bool): True for 5xx responses and for exceptions without a status (timeouts, refused
+            connections, ...)
+    """
+    status = getattr(obj, 'status_code', None) or getattr(obj, 'status', None)
+    response = getattr(obj, 'response', None)
+    if isinstance(response, dict):
+        # botocore ClientError
+        status = response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    elif response is not None and hasattr(response, 'status_code'):
+        # requests HTTPError
+        status = response.status_code
+    if status is None:
+        return isinstance(obj, Exception)
+    return int(status) >= 500
+
+
+class CircuitBreaker:
+    def __init__(self, name, failure_threshold=FAILURE_THRESHOLD):
+        """
+        Circuit breaker for one provider
+
+        Args:
+            name (str): name of the provider
+            failure_threshold (int, optional): consecutive failures before the circuit opens.
+                Defaults to CIRCUIT_FAILURE_THRESHOLD.
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False # A half-open circuit lets one call through at a time
+        self._lock = threading.Lock()
+
+    def call(self, func, *args, **kwargs):
+        """Call the provider unless the circuit is open
+
+        Args:
+            func (callable): client function sending the request
+            *args, **kwargs: passed on to func
+
+        Raises:
+            CircuitOpenError: the circuit is open, or half-open with another call probing the
+                provider, func was not called
+
+        Returns:
+            result: whatever func returns
+        """
+        with self._lock:
+            if self.state == OPEN or (self.state == HALF_OPEN and self._probing):
+                raise CircuitOpenError(self.name)
+            probe = self.state == HALF_OPEN
+            if probe:
+                self._probing = True
+        try:
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if is_provider_failure(e):
+                    self.record_failure()
+                raise
+            if is_provider_failure(result):
+                self.record_failure()
+            else:
+                self.record_success()
+            return result
+        finally:
+            if probe:
+                with self._lock:
+                    self._probing = False
+
+    def record_success(self):
+        with self._lock:
+            if self.state == HALF_OPEN:
+                logger.info(f'Circuit for {self.name} is closed again.')
+            self.state = CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == OPEN:
+                return
+            if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+                self.state = OPEN
+                self.opened_at = datetime.datetime.utcnow()
+                logger.warning(F'"PROVIDER": "{self.name}", "CIRCUIT": "open", '
+                               F'"CONSECUTIVE_FAILURES": "{self.failures}"')
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(provider):
+    """Get the circuit breaker shared by every client of a provider"""
+    with _breakers_lock:
+        if provider not in _breakers:
+            _breakers[provider] = CircuitBreaker(provider)
+        return _breakers[provider]
+
+
+def guarded_call(provider, func, *args, **kwargs):
+    """Send a request through the provider's circuit breaker and rate limiter
+
+    Args:
+        provider (str): one of 'hubspot', 'pdfgenapi', 'pandadoc' or 's3'
+        func (callable): client function sending the request
+        *args, **kwargs: passed on to func
+
+    Returns:
+        result: whatever func returns
+    """
+    return get_breaker(provider).call(get_limiter(provider).call, func, *args, **kwargs)
+
+
+def load_breakers(session):
+    """Restore the circuits saved by the previous run. Circuits that were open are half-open."""
+    for row in session.query(ProviderCircuit).all():
+        breaker = get_breaker(row.provider)
+        if row.state in (OPEN, HALF_OPEN):
+            breaker.state = HALF_OPEN
+            breaker.failures = row.failures
+            breaker.opened_at = row.opened_at
+            logger.info(f'Circuit for {row.provider} was open during the last run, trying it again.')
+
+
+def half_open_breakers():
+    """Give every open circuit another try, for processes that run longer than one run (e.g. the
+    webhook receiver, once per batch). Like at the start of a run, a single probe call is let through."""
+    for provider, breaker in list(_breakers.items()):
+        with breaker._lock:
+            if breaker.state != OPEN:
+                continue
+            breaker.state = HALF_OPEN
+        logger.info(f'Circuit for {provider} was open, trying it again.')
+
+
+def save_breakers(session):
+    """Save the state of every circuit used during the run for the next run"""
+    for provider, breaker in list(_breakers.items()):
+        session.merge(ProviderCircuit(provider=provider, state=breaker.state,
+                                      failures=breaker.failures, opened_at=breaker.opened_at))
+    session.commit()
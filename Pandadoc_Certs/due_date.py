@@ -8,47 +8,90 @@ from dateutil.parser import parse
 from calendar import timegm
 import datetime
 
+from circuit_breaker import guarded_call
+from due_date_store import DueDateStore, same_day
+
 logger = logging.getLogger(F'LinkedInAssignDueDateUpdate.{__name__}')
 
 class DueDate:
-    def __init__(self, objectType='2-8311962', curr_date=datetime.date.today()):
-        """A class to generate the payload to update assignment due date."""
+    def __init__(self, objectType='2-8311962', curr_date=datetime.date.today(), session=None):
+        """A class to generate the payload to update assignment due date.
+
+        Args:
+            objectType (str, optional): Internal name of the object. Defaults to '2-8311962'.
+            curr_date (date, optional): only sessions after this date get a due date. Defaults to today.
+            session (optional): SQLAlchemy session of the local database, to only send the due dates
+                that changed since they were last sent (see due_date_store.py). Without it, due
+                dates are compared with the ones on Hubspot.
+        """
         # Get all the records of an object with specified properties
         self.records = self.get_all_records_with_property(objectType)
         self.curr_date = datetime.datetime.combine(curr_date, datetime.datetime.min.time()).replace(tzinfo=datetime.timezone.utc)
+        self.store = DueDateStore(session) if session is not None else None
         # Update payload for the records
         self.payload = {'inputs': []}
+        # Hubspot id -> (live session datetime, due date) of every record in the payload
+        self.calculated = {}
     
     def calc_assign_due_date(self):
         """
         Takes the records live_session_date and subtracts 2 business days. Subtracts 2 business
-        days and makes the assignment_due_date. Input the information in a payload.
+        days and makes the assignment_due_date. Input the information in a payload, leaving out
+        the records whose due date did not change.
         """
-        for row in self.records.itertuples(index=True, name="Pandas"):
+        if self.store:
+            self.store.prune(self.curr_date)
+        hs_due_dates = self.records['properties.assignment_due_date'] if 'properties.assignment_due_date' in self.records \
+            else pd.Series(None, index=self.records.index)
+        unchanged = 0
+        for hs_id, live_session_datetime, hs_due_date in zip(self.records['id'], self.records['properties.live_session_datetime'], hs_due_dates):
             try:
-                # row[-1] is pulling from properties.live_session_datetime
-                live_session_date = datetime.datetime.fromisoformat(row[-1][:-1]).replace(tzinfo=datetime.timezone.utc) 
+                live_session_date = datetime.datetime.fromisoformat(live_session_datetime[:-1]).replace(tzinfo=datetime.timezone.utc) 
                 if self.curr_date < live_session_date: 
                     assignment_due_date = live_session_date - BDay(2)
                     assignment_due_date_unix = timegm(assignment_due_date.timetuple()) * 1000
-                    self.payload['inputs'].append({'id': row.id, 'properties': {"assignment_due_date": assignment_due_date_unix}})
+                    if self.store:
+                        changed = self.store.changed(hs_id, live_session_date, assignment_due_date_unix, hs_due_date)
+                    else:
+                        changed = not same_day(hs_due_date, assignment_due_date_unix)
+                    if not changed:
+                        unchanged += 1
+                        continue
+                    self.payload['inputs'].append({'id': hs_id, 'properties': {"assignment_due_date": assignment_due_date_unix}})
+                    self.calculated[hs_id] = (live_session_date, assignment_due_date_unix)
             except Exception as e:
                 logger.error(e, exc_info=True)
                 continue
+        if self.store:
+            self.store.commit()
+        logger.info(f'{unchanged} due date(s) are unchanged since they were last sent.')
+
+    def mark_sent(self, inputs):
+        """Remember the due dates of records that were updated on Hubspot
+
+        Args:
+            inputs (list): inputs of the payload that were sent
+        """
+        if not self.store:
+            return
+        for record in inputs:
+            self.store.remember(record['id'], *self.calculated[record['id']])
+        self.store.commit()
     
     def get_all_records_with_property(self, objectType, property_name={'live_session_datetime', 'assignment_due_date'}):
         """Take JSON data from a GET request and generate a dataframe. Extract only the records 
-        that have a live_session_date but no assignment_due_date
+        that have a live_session_date
         Args:
             objectType (str): Internal name of the object to do a GET request
             property_name (dict, optional): a dictionary to pass as a parameter to the GET request
                 to only pull in the properties in the dictionary. Defaults to 
                 {'live_session_datetime', 'assignment_due_date'}.
         Returns:
-            pandas dataframe: A pandas dataframe of only the records that have a live_session_date 
-                but no assignment_due_date
+            pandas dataframe: A pandas dataframe of only the records that have a live_session_date,
+                with or without an assignment_due_date
         """
-        all_records = get_all_records(objectType, add_params={'properties': property_name})
+        all_records = guarded_call('hubspot', get_all_records, objectType, add_params={'properties': property_name})
         records_in_hs = pd.json_normalize(all_records)
-        records_in_hs = records_in_hs[(records_in_hs['properties.live_session_datetime'].notnull()) & ((records_in_hs['properties.assignment_due_date'].isnull()) | (records_in_hs['properties.assignment_due_date']==''))]
+        # A due date that is already set goes stale when the session is moved, so keep those too
+        records_in_hs = records_in_hs[records_in_hs['properties.live_session_datetime'].notnull()]
         return records_in_hs
\ No newline at end of file
@@ -0,0 +1,109 @@
+"""
+Module to remember the assignment due date last sent to Hubspot for every record, along with the
+live session datetime it was calculated from, in the due_date_sent table. Every run calculates the
+due dates of all upcoming sessions, but only the records whose due date changed (e.g. the session
+was rescheduled) are sent to Hubspot.
+"""
+
+import datetime
+import logging
+
+from dateutil.parser import isoparse
+
+from models import DueDateSent
+
+logger = logging.getLogger(F'LinkedInAssignDueDateUpdate.{__name__}')
+
+
+def hs_date_to_unix(value):
+    """Turn a date property as returned by Hubspot into unix epoch milliseconds
+
+    Args:
+        value (str): epoch milliseconds, or an ISO date or datetime
+
+    Returns:
+        (int): epoch milliseconds, None when the property is empty or cannot be read
+    """
+    if value is None or str(value).strip() in ('', 'nan', 'None'):
+        return None
+    value = str(value).strip()
+    if value.isdigit():
+        return int(value)
+    try:
+        parsed = isoparse(value)
+    except ValueError:
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=datetime.timezone.utc)
+    return int(parsed.timestamp() * 1000)
+
+
+def same_day(hs_due_date, assignment_due_date):
+    """Whether the due date on a Hubspot record is the same day as a calculated one"""
+    hs_due_date = hs_date_to_unix(hs_due_date)
+    return hs_due_date is not None and hs_due_date // 86400000 == assignment_due_date // 86400000
+
+
+class DueDateStore:
+    def __init__(self, session):
+        """
+        Class to tell which calculated due dates differ from what Hubspot already has
+
+        Args:
+            session: SQLAlchemy session bound to the local database
+        """
+        self.session = session
+        self._sent = {row.hs_instance_id: row for row in session.query(DueDateSent).all()}
+
+    def changed(self, hs_instance_id, live_session_datetime, assignment_due_date, hs_due_date=None):
+        """Whether a due date has to be sent to Hubspot
+
+        Args:
+            hs_instance_id (int): Hubspot id of the record
+            live_session_datetime (datetime): session the due date was calculated from, in UTC
+            assignment_due_date (int): calculated due date in epoch milliseconds
+            hs_due_date (str, optional): assignment_due_date currently on the Hubspot record
+
+        Returns:
+            (bool): False when the last due date sent (or the one on Hubspot) is the same
+        """
+        sent = self._sent.get(int(hs_instance_id))
+        if sent is not None:
+            if sent.assignment_due_date != assignment_due_date:
+                return True
+            if sent.live_session_datetime != live_session_datetime.replace(tzinfo=None):
+                # Moved within the same day, the due date stays the same
+                self.remember(hs_instance_id, live_session_datetime, assignment_due_date)
+            return False
+        if same_day(hs_due_date, assignment_due_date):
+            # Set before the store existed, remember it so it is not sent again
+            self.remember(hs_instance_id, live_session_datetime, assignment_due_date)
+            return False
+        return True
+
+    def remember(self, hs_instance_id, live_session_datetime, assignment_due_date):
+        """Store a due date as sent, committed with the next call to commit()"""
+        row = DueDateSent(hs_instance_id=int(hs_instance_id),
+                          live_session_datetime=live_session_datetime.replace(tzinfo=None),
+                          assignment_due_date=assignment_due_date,
+                          sent_at=datetime.datetime.utcnow())
+        self._sent[row.hs_instance_id] = self.session.merge(row)
+
+    def commit(self):
+        self.session.commit()
+
+    def prune(self, before):
+        """Forget the due dates of sessions that took place before a datetime (UTC)
+
+        Returns:
+            (int): number of records forgotten
+        """
+        before = before.replace(tzinfo=None)
+        pruned = self.session.query(DueDateSent) \
+            .filter(DueDateSent.live_session_datetime < before) \
+            .delete(synchronize_session=False)
+        self.session.commit()
+        self._sent = {hs_id: row for hs_id, row in self._sent.items()
+                      if row.live_session_datetime is None or row.live_session_datetime >= before}
+        return pruned
+
@@ -1,15 +1,23 @@
 """Module to create set logging levels and handlers"""
 
+import atexit
 import logging
+import queue
 import sys
 
+from logging.handlers import QueueHandler, QueueListener, SysLogHandler
+
 import os # Delete later
 
 import datetime
 
 # Custom formatter
 class MyFormatter(logging.Formatter):
-    """A Class to using inheritance to create a custom formatter"""
+    """
+    A Class to using inheritance to create a custom formatter. Every level gets its own
+    formatter built once up front, so formatting a record never touches shared mutable state and
+    the formatter can be used from several threads at once.
+    """
     dbg_fmt = '{asctime} | {levelname}\n' \
                '    [{name}:{lineno:3}] {message}'
     wrn_fmt = '{asctime} | {levelname}\n' \
@@ -27,47 +35,56 @@ class MyFormatter(logging.Formatter):
 
     def __init__(self):
         super().__init__(fmt="{levelname} {msg}", datefmt=self.dt_format, style='{')
+        dbg_formatter = logging.Formatter(fmt=self.dbg_fmt, datefmt=self.dt_format, style='{')
+        wrn_formatter = logging.Formatter(fmt=self.wrn_fmt, datefmt=self.dt_format, style='{')
+        # Template to use for each logging level
+        self._level_formatters = {
+            logging.DEBUG: dbg_formatter,
+            logging.INFO: dbg_formatter,
+            logging.WARNING: wrn_formatter,
+            logging.ERROR: wrn_formatter,
+            logging.CRITICAL: wrn_formatter
+        }
 
     def format(self, record):
+        # Levels without a template fall back to the original format
+        formatter = self._level_formatters.get(record.levelno)
+        if formatter is None:
+            return super().format(record)
+        return formatter.format(record)
 
-        # Save the original format configured by the user
-        # when the logger formatter was instantiated
-        format_orig = self._style._fmt
 
-        # Replace the original format with one customized by logging level
-        if record.levelno == logging.DEBUG:
-            self._style._fmt = MyFormatter.dbg_fmt
-
-        elif record.levelno == logging.INFO:
-            self._style._fmt = MyFormatter.dbg_fmt
-
-        elif record.levelno == logging.ERROR:
-            self._style._fmt = MyFormatter.wrn_fmt
+class LazyQueueHandler(QueueHandler):
+    """
+    QueueHandler that puts the record on the queue untouched. The default QueueHandler formats the
+    message (and any traceback) before queueing it, which keeps that work on the calling thread.
+    Since the queue never leaves this process, the listener thread can do all of the formatting.
+    """
 
-        elif record.levelno == logging.WARNING:
-            self._style._fmt = MyFormatter.wrn_fmt
-        
-        elif record.levelno == logging.CRITICAL:
-            self._style._fmt = MyFormatter.wrn_fmt
+    def prepare(self, record):
+        return record
 
-        # Call the original formatter class to do the grunt work
-        result = logging.Formatter.format(self, record)
 
-        # Restore the original format configured by the user
-        self._style._fmt = format_orig
+def get_log_dir():
+    """
+    Folder of the log files, LOG_DIR keeps the logs of e.g. the benchmarks out of the log folder
 
-        return result
+    Returns:
+        log_dir (str): path of the folder
+    """
+    return os.getenv('LOG_DIR') or os.path.join(os.path.dirname(__file__) + os.sep, 'log')
 
 def get_file_handler():
     """
     Sets the lowest logging level of the file_handler to DEBUG and format the log message to 
     the custom MyFormatter 
+
     Returns:
         file_handler (class): sends logging output to a disk file
     """
     isodatetime=datetime.datetime.utcnow().isoformat()
     curr_dir = os.getcwd()
-    log_fname = os.path.join(os.path.dirname(__file__) + os.sep, 'log',F'{isodatetime}_LinkedInUpdate.log' )
+    log_fname = os.path.join(get_log_dir(), F'{isodatetime}_LinkedInUpdate.log' )
     file_handler = logging.FileHandler(log_fname, mode='a')
     file_handler.setLevel(logging.DEBUG)
     file_handler.setFormatter(MyFormatter())
@@ -77,6 +94,7 @@ def get_console_handler():
     """
     Sets the lowest logging level of the file_handler to DEBUG and format the log message to 
     the custom MyFormatter 
+
     Returns:
         console_handler (class): sends logging output to the sys.stdout stream
     """
@@ -85,7 +103,7 @@ def get_console_handler():
     console_handler.setFormatter(MyFormatter())
     return console_handler
 
-def get_syslog_handler():
+def get_syslog_handler(paper_trail_address, port):
     """
     Sets the lowest logging level of the file_handler to DEBUG and format the log message to 
     the custom MyFormatter 
@@ -99,21 +117,53 @@ def get_syslog_handler():
     external_handler.setFormatter(MyFormatter())
     return external_handler
 
-def get_logger(logger_name):
+def get_logger(logger_name, use_queue=None):
     """
     Set a logger with 3 handlers from the 3 helper functions above
+
     Args:
         logger_name (str): name of the logger to be used
+        use_queue (bool, optional): Send records through a queue so that formatting and the
+            file/console/syslog I/O happen on a background thread instead of the caller's.
+            Defaults to the LOG_QUEUE environment variable.
+
     Returns:
         logger (class): root logger in the hierachy
     """
+    if use_queue is None:
+        use_queue = os.getenv('LOG_QUEUE', '').lower() in ('1', 'true', 'yes')
+
     # Set the logger
     logger = logging.getLogger(logger_name) 
     logger.setLevel(logging.DEBUG) # better to have too much log than not enough
 
     if not logger.handlers:
-        logger.addHandler(get_file_handler()) # Get rid of later
-        logger.addHandler(get_console_handler())
-        # logger.addHandler(get_syslog_handler()) # add later
+        handlers = [get_file_handler(), # Get rid of later
+                    get_console_handler()]
+                    # get_syslog_handler() # add later
+        if use_queue:
+            logger.addHandler(get_queue_handler(handlers))
+        else:
+            for handler in handlers:
+                logger.addHandler(handler)
 
     return logger
+
+def get_queue_handler(handlers):
+    """
+    Starts a QueueListener on a background thread that passes records on to the given handlers.
+    The listener is stopped (and the queue flushed) when the interpreter exits.
+
+    Args:
+        handlers (list): handlers doing the actual formatting and I/O
+
+    Returns:
+        queue_handler (class): handler that only puts records on the queue
+    """
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    queue_handler = LazyQueueHandler(log_queue)
+    queue_handler.setLevel(logging.DEBUG)
+    return queue_handler
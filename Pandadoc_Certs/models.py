@@ -4,14 +4,18 @@ Hubspot Instance ids that are generated everytime a new certificate is created.
 """
 
 import os
-from sqlalchemy import create_engine, Column, Integer
+from dotenv import load_dotenv
+from sqlalchemy import create_engine, Column, BigInteger, Integer, String, DateTime
 from sqlalchemy.ext.declarative import declarative_base
 
 
 package_dir = os.path.abspath(os.path.dirname(__file__))
 db_dir = os.path.join(package_dir, 'uuid.db')
 
-SQLITE_DB = ''.join(['sqlite:///', db_dir])
+load_dotenv()
+
+# Can be pointed at another database, e.g. a scratch one for the benchmarks
+SQLITE_DB = os.getenv('CERT_DB_URL') or ''.join(['sqlite:///', db_dir])
 
 engine = create_engine(SQLITE_DB) 
 
@@ -25,5 +29,27 @@ class CertIdHistory(Base):
     hs_instance_id = Column(Integer, unique=True)
 
 
+class ProviderCircuit(Base):
+    """State of the circuit breaker of every outside provider, kept between runs"""
+
+    __tablename__ = "provider_circuit"
+
+    provider = Column(String, primary_key=True)
+    state = Column(String)
+    failures = Column(Integer)
+    opened_at = Column(DateTime)
+
+
+class DueDateSent(Base):
+    """Last assignment due date sent to Hubspot for a record and the session it was calculated from"""
+
+    __tablename__ = "due_date_sent"
+
+    hs_instance_id = Column(Integer, primary_key=True)
+    live_session_datetime = Column(DateTime) # UTC
+    assignment_due_date = Column(BigInteger) # Unix epoch milliseconds
+    sent_at = Column(DateTime)
+
+
 Base.metadata.create_all(engine)
 engine.dispose()
\ No newline at end of file
@@ -6,6 +6,7 @@ to the student's LinkedIn account when clicked.
 
 import requests
 import os
+import random
 import logging
 import json
 import time
@@ -18,28 +19,46 @@ from sqlalchemy.exc import SQLAlchemyError, IntegrityError
 from sqlalchemy.orm import sessionmaker, scoped_session
 
 from models import CertIdHistory, SQLITE_DB 
+from circuit_breaker import guarded_call, get_timeout
 
 load_dotenv()
 
 logger = logging.getLogger(F'LinkedInAssignDueDateUpdate.{__name__}')
 
+# Fraction (0 to 1) of successful API requests to log at DEBUG level
+API_LOG_SAMPLE_RATE = float(os.getenv('API_LOG_SAMPLE_RATE', 1))
+
 PANDA_API = os.environ['PANDA_API']
 TEMPLATE_ID = os.environ['TEMPLATE_ID'] # Pandadoc template ID
 FOLDER_ID = os.environ['FOLDER_ID'] # Location in Pandadocs to put templates
+# Can be pointed somewhere else, e.g. at the stand-in of the benchmarks
+PANDA_API_URL = os.getenv('PANDA_API_URL', 'https://api.pandadoc.com/public/v1')
+# Takes 3-5 seconds to change from document.uploaded to document.draft - https://developers.pandadoc.com/reference/new-document
+PANDA_STATUS_WAIT = float(os.getenv('PANDA_STATUS_WAIT', 5))
 
 headers = {'Authorization': f'API-Key {PANDA_API}', 'Content-Type': 'application/json'}
 
 def api_log(res, success_code):
+    """
+    Log the response of an API request. Failures are always logged in full. Successful requests
+    are only logged when DEBUG is enabled, and then only a sampled fraction of them
+    (API_LOG_SAMPLE_RATE) so log volume does not grow with the number of requests.
+
+    Args:
+        res: response of the request
+        success_code (int): status code expected on success
+
+    Returns:
+        res: the response on success, otherwise None
+    """
     if res.status_code == success_code:
-        logger.debug(F'"METHOD": "{res.request.method}", '
-                    F'"STATUS_CODE": "{res.status_code}",'
-                    F'"URL": "{res.url}"', exc_info=True)
+        if logger.isEnabledFor(logging.DEBUG) and random.random() < API_LOG_SAMPLE_RATE:
+            logger.debug('"METHOD": "%s", "STATUS_CODE": "%s","URL": "%s"',
+                         res.request.method, res.status_code, res.url)
         return res
     else:
-        logger.warning(F'"METHOD": "{res.request.method}", '
-                       F'"STATUS_CODE": "{res.status_code}",'
-                       F'"URL": "{res.url}",'
-                       F'"FAIL RESPONSE": "{res.text}"', exc_info=True)
+        logger.warning('"METHOD": "%s", "STATUS_CODE": "%s","URL": "%s","FAIL RESPONSE": "%s"',
+                       res.request.method, res.status_code, res.url, res.text)
         return None
 
 
@@ -87,7 +106,7 @@ class PandaLinkedIn:
         the url dictionary
         """
         doc_id = self.create_pd_cert().json()['id']
-        time.sleep(5) # Takes 3-5 seconds to change from document.uploaded to document.draft - https://developers.pandadoc.com/reference/new-document
+        time.sleep(PANDA_STATUS_WAIT)
         self.update_doc_status(doc_id) # Must change to document.completed to further modify
         cert_id = self.create_cert_url(doc_id).json()['id']
         cert_url = f'https://app.pandadoc.com/s/{cert_id}' # Create the url to the cert
@@ -104,7 +123,7 @@ class PandaLinkedIn:
             res: API response for certificate generation
         """
         # template ID logic; if "generate" field known and is true, push corresponding PD template ID and timestamp to dict
-        url = "https://api.pandadoc.com/public/v1/documents"
+        url = f"{PANDA_API_URL}/documents"
         payload = {
             "name": f"{self.course_name} - {self.firstname} {self.lastname} Certificate",
             "template_uuid": TEMPLATE_ID,
@@ -117,19 +136,21 @@ class PandaLinkedIn:
             ]
         }
 
-        res = requests.post(url, headers=headers, data=json.dumps(payload))
+        res = guarded_call('pandadoc', requests.post, url, headers=headers, data=json.dumps(payload),
+                           timeout=get_timeout('pandadoc'))
 
         return api_log(res, 201)
 
     def update_doc_status(self, doc_id):
         """Change to document.completed in order to actually further process the cert"""
-        url = f"https://api.pandadoc.com/public/v1/documents/{doc_id}/status/"
+        url = f"{PANDA_API_URL}/documents/{doc_id}/status/"
 
         payload = {
             "status": 2 # code for document.completed
         }
 
-        res = requests.patch(url, headers=headers, data=json.dumps(payload))
+        res = guarded_call('pandadoc', requests.patch, url, headers=headers, data=json.dumps(payload),
+                           timeout=get_timeout('pandadoc'))
 
         return api_log(res, 204)
 
@@ -142,18 +163,19 @@ class PandaLinkedIn:
         Returns:
             res: API JSON response
         """
-        url = f"https://api.pandadoc.com/public/v1/documents/{doc_id}/session"
+        url = f"{PANDA_API_URL}/documents/{doc_id}/session"
 
         payload = {
             'silent': 'true',
             "recipient": self.email
         }
 
-        res= requests.post(url, data=json.dumps(payload), headers=headers)
+        res= guarded_call('pandadoc', requests.post, url, data=json.dumps(payload), headers=headers,
+                          timeout=get_timeout('pandadoc'))
 
         return api_log(res, 201)
 
-    def create_linkedin_url(self, merged_doc_url, org_id):
+    def create_linkedin_url(self, merged_doc_url, org_id=12958828):
         """Creates the LinkedIn badge url of the cert. A student can click on the url to add the
         Cert to their LinkedIn profile.
 
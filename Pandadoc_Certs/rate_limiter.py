@@ -0,0 +1,200 @@
+"""
+Module with an adaptive rate limiter shared by every client talking to an outside provider
+(Hubspot, PDFGeneratorAPI, Pandadoc and S3).
+
+Each provider gets a token bucket whose rate follows AIMD: every successful request raises the
+rate a little (up to a maximum), every throttled response (HTTP 429, S3 SlowDown) halves it and
+honours the provider's Retry-After header before any other request is let through. The rate
+therefore settles around the highest rate the provider accepts.
+
+Rates are in requests per second and can be set per provider in the .env file:
+    RATE_LIMIT_HUBSPOT=10       starting rate
+    RATE_LIMIT_HUBSPOT_MAX=20   highest rate to probe up to (defaults to twice the starting rate)
+"""
+
+import email.utils
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(F'LinkedInAssignDueDateUpdate.{__name__}')
+
+# Starting requests per second of each provider when not set in the environment
+DEFAULT_RATES = {
+    'hubspot': 10,
+    'pdfgenapi': 2,
+    'pandadoc': 5,
+    's3': 50
+}
+
+# Error codes S3 uses instead of a 429
+AWS_THROTTLE_CODES = {'SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded'}
+
+
+def parse_retry_after(value):
+    """Turn a Retry-After header, either seconds or an HTTP date, into seconds to wait
+
+    Args:
+        value (str): value of the Retry-After header
+
+    Returns:
+        seconds (float): seconds to wait, 0 when the header is missing or unreadable
+    """
+    if not value:
+        return 0
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+        return max(0, retry_at.timestamp() - time.time())
+    except (TypeError, ValueError):
+        return 0
+
+
+def throttle_delay(obj):
+    """Check whether a response or exception from any of the clients means we were throttled
+
+    Args:
+        obj: requests response, pdf_generator_api_client.ApiException, botocore ClientError or
+            anything else returned by a client
+
+    Returns:
+        delay (float): seconds the provider asked us to wait (0 when it did not say), or None
+            when the request was not throttled
+    """
+    status = getattr(obj, 'status_code', None) or getattr(obj, 'status', None)
+    headers = getattr(obj, 'headers', None) or {}
+    response = getattr(obj, 'response', None)
+    if isinstance(response, dict):
+        # botocore ClientError
+        metadata = response.get('ResponseMetadata', {})
+        status = metadata.get('HTTPStatusCode')
+        headers = metadata.get('HTTPHeaders', {})
+        if response.get('Error', {}).get('Code') in AWS_THROTTLE_CODES:
+            status = 429
+    elif response is not None and hasattr(response, 'status_code'):
+        # requests HTTPError
+        status = response.status_code
+        headers = response.headers
+    if status != 429:
+        return None
+    return parse_retry_after(headers.get('Retry-After') or headers.get('retry-after'))
+
+
+class AdaptiveRateLimiter:
+    def __init__(self, name, rate, max_rate=None, min_rate=0.1, decrease=0.5, max_retries=3):
+        """
+        Token bucket limiting the requests sent to one provider, with a rate that adjusts itself
+        to throttling responses.
+
+        Args:
+            name (str): name of the provider, used in the logs
+            rate (float): starting requests per second
+            max_rate (float, optional): highest rate to increase up to. Defaults to twice rate.
+            min_rate (float, optional): lowest rate to decrease down to. Defaults to 0.1.
+            decrease (float, optional): factor the rate is multiplied by when throttled.
+                Defaults to 0.5.
+            max_retries (int, optional): times call() retries a throttled request. Defaults to 3.
+        """
+        self.name = name
+        self.rate = float(rate)
+        self.max_rate = float(max_rate or rate * 2)
+        self.min_rate = min_rate
+        self.decrease = decrease
+        # Go from the minimum back up to the starting rate in about 20 successful requests
+        self.increase = max(self.rate / 20, 0.01)
+        self.max_retries = max_retries
+        self._tokens = 1.0
+        self._last = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a request may be sent to the provider"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                # Allow a burst of at most one second worth of requests
+                self._tokens = min(max(self.rate, 1.0), self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                elif self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                else:
+                    wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def on_success(self):
+        """Additive increase after a request went through"""
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttle(self, retry_after=0):
+        """Multiplicative decrease after a throttled request
+
+        Args:
+            retry_after (float, optional): seconds the provider asked us to wait. Defaults to 0.
+        """
+        with self._lock:
+            self.rate = max(self.min_rate, self.rate * self.decrease)
+            self._tokens = 0.0
+            if retry_after:
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+        logger.warning(F'"PROVIDER": "{self.name}", "THROTTLED": "true", '
+                       F'"RETRY_AFTER": "{retry_after}", "NEW_RATE": "{self.rate:.2f}/s"')
+
+    def call(self, func, *args, **kwargs):
+        """Send a request through the limiter, retrying it when the provider throttles it
+
+        Args:
+            func (callable): client function sending the request
+            *args, **kwargs: passed on to func
+
+        Returns:
+            result: whatever func returns. A throttled response is returned as is once the retries
+                run out; exceptions other than throttling are raised straight away.
+        """
+        for attempt in range(self.max_retries + 1):
+            self.acquire()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                delay = throttle_delay(e)
+                if delay is None or attempt == self.max_retries:
+                    raise
+                self.on_throttle(delay)
+                continue
+            delay = throttle_delay(result)
+            if delay is None:
+                self.on_success()
+                return result
+            self.on_throttle(delay)
+            if attempt == self.max_retries:
+                return result
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def get_limiter(provider):
+    """Get the limiter shared by every client of a provider
+
+    Args:
+        provider (str): one of 'hubspot', 'pdfgenapi', 'pandadoc' or 's3'
+
+    Returns:
+        limiter (AdaptiveRateLimiter): the same instance for every call with the same provider
+    """
+    with _limiters_lock:
+        if provider not in _limiters:
+            env_name = f'RATE_LIMIT_{provider.upper()}'
+            rate = float(os.getenv(env_name, DEFAULT_RATES.get(provider, 5)))
+            max_rate = os.getenv(f'{env_name}_MAX')
+            _limiters[provider] = AdaptiveRateLimiter(provider, rate, float(max_rate) if max_rate else None)
+        return _limiters[provider]
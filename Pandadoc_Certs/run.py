@@ -1,8 +1,9 @@
 """Main module to generate cert url, LinkedIn Badge URL, and subtract 2 business days from session date for an assignment due date"""
 
+import argparse
 import json
 
-from datetime import date, datetime
+import datetime
 from calendar import timegm
 
 from hubapi import search_records, UpdateRecordsHandler
@@ -10,6 +11,8 @@ from logger import get_logger
 
 from panda_linkedin_urls import PandaLinkedIn
 from due_date import DueDate
+from circuit_breaker import CircuitOpenError, guarded_call, load_breakers, save_breakers
+from run_profiler import profiler
 
 from models import SQLITE_DB
 
@@ -58,7 +61,8 @@ class LinkedInBadgeDueDate:
                 "course_name", 
                 "linkedin_company_id",
                 "cle",
-                "cle_state_bar_number__and_state__if_not_specified_above_"
+                "cle_state_bar_number__and_state__if_not_specified_above_",
+                "email"
             ],
             "limit": 100,
             "after": 0
@@ -74,8 +78,29 @@ class LinkedInBadgeDueDate:
         # Change the object here during projection
 
     def run(self):
-        self._linkedinbadge()
-        self._assign_date()
+        load_breakers(self.session)
+        profiler.start()
+        try:
+            for name, stage in (('linkedinbadge', self._linkedinbadge), ('assign_date', self._assign_date)):
+                try:
+                    profiler.wrap(name, stage)()
+                except CircuitOpenError as c:
+                    # Hubspot is down, the other stage and the circuit states still have to be saved
+                    self.logger.warning(f'{c} Skipping the rest of {name} until the next run.')
+        finally:
+            profiler.stop()
+            self.save_run_state()
+
+    def save_run_state(self):
+        """Store the circuit breaker states in the local database. Never fails the run."""
+        try:
+            save_breakers(self.session)
+        except SQLAlchemyError as s:
+            self.logger.error(s, exc_info=True)
+            self.session.rollback()
+        finally:
+            self.session.close()
+            self.engine.dispose()
 
     def get_session(self):
         """Creates a new database self.session for instant use"""
@@ -92,18 +117,21 @@ class LinkedInBadgeDueDate:
         badge = LinkedInBadgeDueDate()
 
         self.logger.info('Retrieving data from Hubspot...')
-        instances_json = search_records(self.instance_obj, self._payload_search_hs).json()
+        instances_json = guarded_call('hubspot', search_records, self.instance_obj, self._payload_search_hs).json()
         self.logger.info(f'... Obtained {len(instances_json["results"])} instances to create certifications for.\n')
 
         self.logger.info(f'Creating Certifications and LinkedIn URL\n')
-        for instance in instances_json["results"]:
+        for i, instance in enumerate(instances_json["results"]):
             try:
                 record = PandaLinkedIn(instance, self.isodate, self.engine, self.session)
-                record.gather_urls()
+                profiler.wrap('gather_urls', record.gather_urls)()
                 self.update_payload_hs['inputs'].append({'id': instance['id'], 
                                                         'properties': record.urls | {'certificate_issue_year': int(self.isodate.year), 
                                                                                     'certificate_issue_month': int(self.isodate.month),
                                                                                     'certificate_issue_date': self.hs_date}})
+            except CircuitOpenError as c:
+                self.logger.warning(f'{c} Skipping the remaining {len(instances_json["results"]) - i} instance(s) until the next run.')
+                break
             except SQLAlchemyError as s:
                 self.logger.error(s, exc_info=True)
                 continue
@@ -113,7 +141,7 @@ class LinkedInBadgeDueDate:
         self.logger.info(f'\nUrls for {len(self.update_payload_hs["inputs"])} instance(s) have been created.\n')
 
         add_linkedin_badge = UpdateRecordsHandler('2-7353817')
-        add_linkedin_badge.dispatch(self.update_payload_hs)
+        guarded_call('hubspot', add_linkedin_badge.dispatch, self.update_payload_hs)
 
         self.session.close()
         self.engine.dispose()
@@ -124,11 +152,13 @@ class LinkedInBadgeDueDate:
         """Main method to gather the assignment due date and update on Hubspot"""
         self.logger.info(f'\n--- BEGIN ASSIGNMENTMENT DUE DATE CALCULATION ---\n')
 
-        
-        get_appropriate_records = DueDate()
+        # Only the due dates that changed since they were last sent are in the payload
+        get_appropriate_records = DueDate(session=self.session)
         get_appropriate_records.calc_assign_due_date()
-        add_assign_due_date = UpdateRecordsHandler('2-7353817')
-        add_assign_due_date.dispatch(get_appropriate_records.payload)
+        if get_appropriate_records.payload['inputs']:
+            add_assign_due_date = UpdateRecordsHandler('2-7353817')
+            guarded_call('hubspot', add_assign_due_date.dispatch, get_appropriate_records.payload)
+            get_appropriate_records.mark_sent(get_appropriate_records.payload['inputs'])
         try:
             self.logger.info(f'\n{len(get_appropriate_records.payload["inputs"])} due date(s) have been added.\n')
         except Exception as e:
@@ -137,5 +167,12 @@ class LinkedInBadgeDueDate:
         self.logger.info(f'\n--- END ASSIGNMENTMENT DUE DATE CALCULATION ({self.isodate}) ---')
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create the certificates and due dates and update them on Hubspot.')
+    parser.add_argument('--profile', action='store_true',
+                        help='profile every stage and write the profiles next to the run log (defaults to RUN_PROFILE)')
+    args = parser.parse_args()
+    if args.profile:
+        profiler.enable()
+
     daily_run = LinkedInBadgeDueDate()
     daily_run.run()
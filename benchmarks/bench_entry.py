@@ -0,0 +1,39 @@
+"""
+Runs one runner inside its own process for run_benchmarks.py and prints its startup time (imports
+and setting up the runner), the wall time of run() and the peak memory of the process as the last
+line of its output, in JSON.
+
+Usage:
+    python bench_entry.py <package folder>
+"""
+
+import json
+import os
+import resource
+import sys
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def main():
+    package_dir = os.path.abspath(sys.argv[1])
+    # The stand-in hubapi goes before the package so it is imported instead of the package's
+    sys.path[:0] = [os.path.join(BENCH_DIR, 'stand_ins'), package_dir]
+    os.chdir(package_dir)
+
+    start = time.perf_counter()
+    from run import LinkedInBadgeDueDate
+    runner = LinkedInBadgeDueDate()
+    started = time.perf_counter()
+    runner.run()
+    wall_time = time.perf_counter() - started
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_mb = peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+    print(json.dumps({'startup_time': started - start, 'wall_time': wall_time, 'peak_memory_mb': peak_mb}), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,336 @@
+"""
+Local stand-ins for the Hubspot, PDFGeneratorAPI and Pandadoc APIs used by the benchmarks. One
+HTTP server answers all three on the paths the real APIs use, from a synthetic dataset held in
+memory, with a configurable latency and error rate per provider. S3 is left to moto (see
+run_benchmarks.py).
+
+Latencies are the mean of an exponential distribution, so some requests are a lot slower than
+the mean like on the real APIs. Errors are 429s (with Retry-After: 1) for Hubspot and 500s for the
+others.
+"""
+
+import base64
+import datetime
+import json
+import random
+import re
+import threading
+import time
+import uuid
+
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+PROVIDERS = ('hubspot', 'pdfgenapi', 'pandadoc')
+
+COURSES = ['Advanced Contract Drafting', 'Privacy Law Essentials', 'Intro to Legal Operations',
+           'Negotiation Skills for Lawyers', 'E-Discovery Foundations']
+FIRST_NAMES = ['Ada', 'Grace', 'Alan', 'Edsger', 'Barbara', 'Ken', 'Margaret', 'Donald']
+LAST_NAMES = ['Lovelace', 'Hopper', 'Turing', 'Dijkstra', 'Liskov', 'Thompson', 'Hamilton', 'Knuth']
+
+
+def fake_pdf(size):
+    """A valid single page pdf padded with a comment to about `size` bytes"""
+    body = (b'%PDF-1.4\n'
+            b'1 0 obj << /Type /Catalog /Pages 2 0 R >> endobj\n'
+            b'2 0 obj << /Type /Pages /Kids [3 0 R] /Count 1 >> endobj\n'
+            b'3 0 obj << /Type /Page /Parent 2 0 R /MediaBox [0 0 792 612] >> endobj\n')
+    padding = max(0, size - len(body) - 64)
+    body += b'%' + b'0' * padding + b'\n'
+    return body + b'trailer << /Root 1 0 R >>\n%%EOF\n'
+
+
+class Dataset:
+    def __init__(self, size, seed=0):
+        """
+        Synthetic course records: every record completed the course and the survey, has no
+        certificate yet and an upcoming live session, about 1 in 5 has CLE details
+
+        Args:
+            size (int): number of records
+            seed (int, optional): seed of the generator, the same seed gives the same records
+        """
+        rng = random.Random(seed)
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        self.records = {}
+        for i in range(size):
+            hs_id = str(100000 + i)
+            firstname, lastname = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+            cle = rng.random() < 0.2
+            session = now + datetime.timedelta(days=rng.randint(1, 60), hours=rng.randint(0, 23))
+            self.records[hs_id] = {
+                'updatedAt': (now - datetime.timedelta(minutes=rng.randint(1, 60 * 24 * 14))).isoformat() + 'Z',
+                'properties': {
+                    'hs_object_id': hs_id,
+                    'firstname': firstname,
+                    'lastname': lastname,
+                    'email': f'{firstname}.{lastname}.{i}@example.com'.lower(),
+                    'course_name': rng.choice(COURSES),
+                    'linkedin_company_id': '12958828',
+                    'cle': str(rng.choice([1, 1.5, 2, 3])) if cle else None,
+                    'cle_state_bar_number__and_state__if_not_specified_above_': f'CA {rng.randint(100000, 999999)}' if cle else None,
+                    'certificate_checkbox': 'true',
+                    'survey_completed': 'true',
+                    'linkedin_badge': None,
+                    'live_session_datetime': session.isoformat() + 'Z',
+                    'assignment_due_date': None,
+                }
+            }
+        self.ids = sorted(self.records, key=int)
+        self.lock = threading.Lock()
+        # Matching ids of every search payload seen since the last update, so paging through
+        # a search does not scan every record for every page
+        self._search_cache = {}
+
+    def search(self, payload):
+        key = json.dumps(payload.get('filterGroups', []), sort_keys=True)
+        with self.lock:
+            if key not in self._search_cache:
+                self._search_cache[key] = [hs_id for hs_id in self.ids
+                                           if matches(self.records[hs_id]['properties'], payload.get('filterGroups'))]
+            return self._search_cache[key]
+
+    def update(self, inputs):
+        with self.lock:
+            updated = 0
+            for record in inputs:
+                if str(record['id']) in self.records:
+                    self.records[str(record['id'])]['properties'].update(
+                        {name: None if value is None else str(value) for name, value in record['properties'].items()})
+                    updated += 1
+            self._search_cache.clear()
+            return updated
+
+
+def matches(properties, filter_groups):
+    """Whether record properties match Hubspot search filter groups (OR of groups, AND of filters)"""
+    if not filter_groups:
+        return True
+    for group in filter_groups:
+        ok = True
+        for f in group.get('filters', []):
+            value = properties.get(f['propertyName'])
+            operator = f['operator']
+            if operator == 'EQ':
+                ok = str(value).lower() == str(f.get('value')).lower()
+            elif operator == 'NEQ':
+                ok = str(value).lower() != str(f.get('value')).lower()
+            elif operator == 'HAS_PROPERTY':
+                ok = value not in (None, '')
+            elif operator == 'NOT_HAS_PROPERTY':
+                ok = value in (None, '')
+            elif operator == 'IN':
+                ok = str(value) in {str(v) for v in f.get('values', [])}
+            else:
+                raise ValueError(f'Operator {operator} is not supported by the stand-in.')
+            if not ok:
+                break
+        if ok:
+            return True
+    return False
+
+
+class Profile:
+    def __init__(self, latency=0.0, error_rate=0.0):
+        """Mean latency in seconds and fraction of failed requests of one provider"""
+        self.latency = latency
+        self.error_rate = error_rate
+
+
+class FakeProviders:
+    def __init__(self, dataset, profiles=None, pdf_size=30000, seed=0):
+        """
+        HTTP server standing in for Hubspot, PDFGeneratorAPI and Pandadoc
+
+        Args:
+            dataset (Dataset): records served by the Hubspot stand-in
+            profiles (dict, optional): Profile of every provider. Defaults to no latency or errors.
+            pdf_size (int, optional): bytes of every rendered pdf. Defaults to 30000.
+            seed (int, optional): seed of the latency and error generator
+        """
+        self.dataset = dataset
+        self.profiles = {provider: Profile() for provider in PROVIDERS}
+        self.profiles.update(profiles or {})
+        self.pdf = fake_pdf(pdf_size)
+        self.pdf_base64 = base64.b64encode(self.pdf).decode()
+        self.documents = {}
+        self.stats = Counter()
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.server = None
+
+    def delay_or_fail(self, provider):
+        """Sleep like the provider would, return True when this request should fail"""
+        profile = self.profiles[provider]
+        with self._lock:
+            delay = self._rng.expovariate(1 / profile.latency) if profile.latency else 0
+            fail = self._rng.random() < profile.error_rate
+            self.stats[f'{provider}_requests'] += 1
+            if fail:
+                self.stats[f'{provider}_errors'] += 1
+        if delay:
+            time.sleep(delay)
+        return fail
+
+    def count(self, name, amount=1):
+        with self._lock:
+            self.stats[name] += amount
+
+    def start(self, host='127.0.0.1', port=0):
+        """Serve on a background thread and return the base url"""
+        self.server = ThreadingHTTPServer((host, port), make_handler(self))
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name='fake-providers', daemon=True).start()
+        return f'http://{host}:{self.server.server_address[1]}'
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+HS_OBJECTS = re.compile(r'^/crm/v3/objects/([^/]+)(/search|/batch/update)?$')
+PDFGEN_OUTPUT = re.compile(r'/templates/(\d+)/output$')
+PANDA_DOCUMENTS = re.compile(r'^/public/v1/documents(?:/([^/]+)(/status/?|/session|/download)?)?$')
+
+
+def make_handler(fake):
+    """Request handler class answering for every stand-in"""
+
+    class FakeHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def _body(self):
+            length = int(self.headers.get('Content-Length', 0))
+            return self.rfile.read(length) if length else b''
+
+        def _send(self, status, payload=None, content_type='application/json', headers=None):
+            body = b'' if payload is None else payload if isinstance(payload, bytes) else json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _fail(self, provider):
+            if provider == 'hubspot':
+                self._send(429, {'status': 'error', 'message': 'You have reached your secondly limit.',
+                                 'category': 'RATE_LIMITS'}, headers={'Retry-After': '1'})
+            else:
+                self._send(500, {'message': 'Internal server error'})
+
+        def _route(self, method):
+            path = urlparse(self.path).path
+            body = self._body()
+            if path == '/__stats':
+                self._send(200, dict(fake.stats))
+                return
+            hs = HS_OBJECTS.match(path)
+            if hs:
+                if fake.delay_or_fail('hubspot'):
+                    self._fail('hubspot')
+                else:
+                    self._hubspot(method, hs.group(2), json.loads(body or b'{}'))
+                return
+            if PDFGEN_OUTPUT.search(path) and method == 'POST':
+                if fake.delay_or_fail('pdfgenapi'):
+                    self._fail('pdfgenapi')
+                else:
+                    query = parse_qs(urlparse(self.path).query)
+                    name = query.get('name', ['document'])[0]
+                    fake.count('pdfgenapi_rendered')
+                    self._send(200, {'response': fake.pdf_base64,
+                                     'meta': {'name': f'{name}.pdf', 'display_name': name, 'encoding': 'base64',
+                                              'content-type': 'application/pdf'}})
+                return
+            panda = PANDA_DOCUMENTS.match(path)
+            if panda:
+                if fake.delay_or_fail('pandadoc'):
+                    self._fail('pandadoc')
+                else:
+                    self._pandadoc(method, panda.group(1), panda.group(2), json.loads(body or b'{}') if method != 'GET' else {})
+                return
+            self._send(404, {'message': f'No stand-in for {method} {path}'})
+
+        def _hubspot(self, method, action, payload):
+            query = parse_qs(urlparse(self.path).query)
+            if action == '/search':
+                ids = fake.dataset.search(payload)
+                after, limit = int(payload.get('after') or 0), min(int(payload.get('limit') or 10), 100)
+                self._send(200, self._page(ids, after, limit, payload.get('properties', [])))
+            elif action == '/batch/update':
+                inputs = payload.get('inputs', [])
+                if len(inputs) > 100:
+                    self._send(400, {'status': 'error', 'message': 'Batch updates take at most 100 inputs.'})
+                    return
+                fake.dataset.update(inputs)
+                fake.count('hubspot_records_updated', len(inputs))
+                fake.count('certificates_issued', sum('linkedin_badge' in record['properties'] for record in inputs))
+                fake.count('due_dates_set', sum('assignment_due_date' in record['properties'] for record in inputs))
+                self._send(200, {'status': 'COMPLETE', 'results': [{'id': str(record['id'])} for record in inputs]})
+            elif method == 'GET':
+                after, limit = int(query.get('after', [0])[0]), min(int(query.get('limit', [10])[0]), 100)
+                properties = ','.join(query.get('properties', [])).split(',')
+                self._send(200, self._page(fake.dataset.ids, after, limit, properties))
+            else:
+                self._send(405, {'message': 'Not supported by the stand-in'})
+
+        @staticmethod
+        def _page(ids, after, limit, properties):
+            page = ids[after:after + limit]
+            with fake.dataset.lock:
+                results = [{'id': hs_id,
+                            'properties': {name: fake.dataset.records[hs_id]['properties'].get(name) for name in properties if name},
+                            'createdAt': fake.dataset.records[hs_id]['updatedAt'],
+                            'updatedAt': fake.dataset.records[hs_id]['updatedAt'],
+                            'archived': False} for hs_id in page]
+            payload = {'total': len(ids), 'results': results}
+            if after + limit < len(ids):
+                payload['paging'] = {'next': {'after': str(after + limit)}}
+            return payload
+
+        def _pandadoc(self, method, doc_id, action, payload):
+            if doc_id is None and method == 'POST':
+                doc_id = uuid.uuid4().hex[:22]
+                with fake._lock:
+                    fake.documents[doc_id] = 'document.draft'
+                fake.count('pandadoc_documents')
+                self._send(201, {'id': doc_id, 'name': payload.get('name'), 'status': 'document.uploaded'})
+            elif doc_id not in fake.documents:
+                self._send(404, {'type': 'not_found', 'detail': 'Not found'})
+            elif action is None and method == 'GET':
+                self._send(200, {'id': doc_id, 'status': fake.documents[doc_id]})
+            elif action is None and method == 'DELETE':
+                with fake._lock:
+                    fake.documents.pop(doc_id, None)
+                self._send(204)
+            elif action and action.startswith('/status') and method == 'PATCH':
+                with fake._lock:
+                    fake.documents[doc_id] = 'document.completed'
+                self._send(204)
+            elif action == '/session' and method == 'POST':
+                self._send(201, {'id': uuid.uuid4().hex[:22], 'expires_at': '2099-01-01T00:00:00.000Z'})
+            elif action == '/download' and method == 'GET':
+                self._send(200, fake.pdf, content_type='application/pdf')
+            else:
+                self._send(405, {'type': 'request_error', 'detail': 'Not supported by the stand-in'})
+
+        def do_GET(self):
+            self._route('GET')
+
+        def do_POST(self):
+            self._route('POST')
+
+        def do_PATCH(self):
+            self._route('PATCH')
+
+        def do_DELETE(self):
+            self._route('DELETE')
+
+        def log_message(self, format, *args):
+            pass
+
+    return FakeHandler
@@ -0,0 +1,205 @@
+"""
+End-to-end benchmarks of the PDFGenAPI_Certs and Pandadoc_Certs runners against local stand-ins
+of Hubspot, PDFGeneratorAPI and Pandadoc (fake_providers.py) and S3 (a moto server), so nothing
+real is called. Every runner and dataset size runs in a fresh process with its own scratch
+database and logs, and the records/sec, wall time and peak memory of every run are reported.
+
+Usage:
+    python run_benchmarks.py [--sizes 100 1000 10000 100000] [--runners pdfgenapi pandadoc]
+                             [--latency pdfgenapi=0.4 --latency hubspot=0.05]
+                             [--error-rate pdfgenapi=0.01] [--env UPLOAD_MODE=write_behind]
+"""
+
+import argparse
+import datetime
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from urllib.request import urlopen
+
+from fake_providers import PROVIDERS, Dataset, FakeProviders, Profile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+RUNNERS = {
+    'pdfgenapi': os.path.join(REPO_DIR, 'PDFGenAPI_Certs'),
+    'pandadoc': os.path.join(REPO_DIR, 'Pandadoc_Certs'),
+}
+BUCKET = 'benchmark-certificates'
+
+# Settings of the runners, so whatever is in their .env file does not change the results. Any of
+# them can be changed with --env.
+RUNNER_ENV = {
+    'HS_TOKEN': 'benchmark',
+    'PDFGENAPI_JWT': 'benchmark',
+    'PANDA_API': 'benchmark',
+    'TEMPLATE_ID': 'benchmark-template',
+    'FOLDER_ID': 'benchmark-folder',
+    'PANDA_STATUS_WAIT': '0',
+    'AWS_S3_BUCKET': BUCKET,
+    'AWS_ACCESS_KEY_ID': 'testing',
+    'AWS_SECRET_ACCESS_KEY': 'testing',
+    'AWS_DEFAULT_REGION': 'us-east-1',
+    'UPLOAD_MODE': 'direct',
+    'CLE_MODE': 'render',
+    'RENDER_BACKENDS': 'pdfgenapi',
+    'WORK_LEASES': '0',
+    'RUN_BUDGET': '0',
+    'LOG_QUEUE': '0',
+    'API_LOG_SAMPLE_RATE': '1',
+}
+# Rates high enough for the limiters never to be what is being measured, see --keep-rate-limits
+UNLIMITED_RATE = '100000'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_s3():
+    """Start a moto S3 server with the benchmark bucket and return it with its url"""
+    import boto3
+    from moto.server import ThreadedMotoServer
+
+    port = free_port()
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+    server.start()
+    url = f'http://127.0.0.1:{port}'
+    boto3.client('s3', endpoint_url=url, aws_access_key_id='testing', aws_secret_access_key='testing',
+                 region_name='us-east-1').create_bucket(Bucket=BUCKET)
+    return server, url
+
+
+def parse_settings(values, cast=float):
+    """Turn provider=value arguments into a dict"""
+    settings = {}
+    for value in values or []:
+        name, _, setting = value.partition('=')
+        if name not in PROVIDERS:
+            raise SystemExit(f'Unknown provider "{name}", use one of {", ".join(PROVIDERS)}.')
+        settings[name] = cast(setting)
+    return settings
+
+
+def run_one(runner, size, args, profiles):
+    """Benchmark one runner on a dataset of `size` records
+
+    Returns:
+        result (dict): settings, timings, peak memory and the counts of the stand-ins
+    """
+    scratch = tempfile.mkdtemp(prefix=f'bench-{runner}-{size}-')
+    fake = FakeProviders(Dataset(size, seed=args.seed), profiles, pdf_size=args.pdf_size, seed=args.seed)
+    base_url = fake.start()
+    s3_server = None
+    try:
+        env = dict(os.environ, **RUNNER_ENV)
+        env.update({
+            'HUBSPOT_API_URL': base_url,
+            'PDFGENAPI_HOST': f'{base_url}/api/v4',
+            'PANDA_API_URL': f'{base_url}/public/v1',
+            'CERT_DB_URL': f'sqlite:///{os.path.join(scratch, "uuid.db")}',
+            'LOG_DIR': scratch,
+        })
+        if runner == 'pdfgenapi':
+            s3_server, env['AWS_S3_ENDPOINT_URL'] = start_s3()
+        if not args.keep_rate_limits:
+            for provider in ('hubspot', 'pdfgenapi', 'pandadoc', 's3'):
+                env[f'RATE_LIMIT_{provider.upper()}'] = env[f'RATE_LIMIT_{provider.upper()}_MAX'] = UNLIMITED_RATE
+        for value in args.env or []:
+            name, _, setting = value.partition('=')
+            env[name] = setting
+
+        output_path = os.path.join(scratch, 'output.log')
+        start = time.perf_counter()
+        with open(output_path, 'w') as output:
+            completed = subprocess.run([sys.executable, os.path.join(BENCH_DIR, 'bench_entry.py'), RUNNERS[runner]],
+                                       env=env, stdout=output, stderr=subprocess.STDOUT, timeout=args.timeout)
+        process_time = time.perf_counter() - start
+        with open(output_path) as output:
+            lines = output.read().strip().splitlines()
+        try:
+            timings = json.loads(lines[-1])
+        except (IndexError, ValueError):
+            timings = {'wall_time': process_time, 'peak_memory_mb': None}
+        stats = json.loads(urlopen(f'{base_url}/__stats').read())
+        issued = stats.get('certificates_issued', 0)
+        return {
+            'runner': runner,
+            'records': size,
+            'exit_code': completed.returncode,
+            'certificates_issued': issued,
+            'due_dates_set': stats.get('due_dates_set', 0),
+            'records_per_sec': issued / timings['wall_time'] if timings['wall_time'] else None,
+            'startup_time': timings.get('startup_time'),
+            'wall_time': timings['wall_time'],
+            'peak_memory_mb': timings['peak_memory_mb'],
+            'provider_stats': stats,
+            'output': output_path,
+        }
+    finally:
+        fake.stop()
+        if s3_server:
+            s3_server.stop()
+        if not args.keep_scratch:
+            shutil.rmtree(scratch, ignore_errors=True)
+
+
+def print_result(result):
+    rps = f'{result["records_per_sec"]:.1f}' if result['records_per_sec'] is not None else '-'
+    memory = f'{result["peak_memory_mb"]:.0f}' if result['peak_memory_mb'] is not None else '-'
+    failed = '' if result['exit_code'] == 0 else f'  (exit code {result["exit_code"]}, see {result["output"]})'
+    print(f'{result["runner"]:<10} {result["records"]:>8} {result["certificates_issued"]:>8} {rps:>10} '
+          f'{result["wall_time"]:>9.1f} {memory:>8}{failed}', flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the runners against local stand-ins of every provider.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100, 1000, 10000, 100000],
+                        help='number of records of every dataset')
+    parser.add_argument('--runners', nargs='+', choices=sorted(RUNNERS), default=sorted(RUNNERS, reverse=True))
+    parser.add_argument('--latency', action='append', metavar='PROVIDER=SECONDS',
+                        help='mean latency of a provider, e.g. pdfgenapi=0.4 (repeatable)')
+    parser.add_argument('--error-rate', action='append', metavar='PROVIDER=FRACTION',
+                        help='fraction of failed requests of a provider, e.g. hubspot=0.01 (repeatable)')
+    parser.add_argument('--pdf-size', type=int, default=30000, help='bytes of every rendered pdf')
+    parser.add_argument('--env', action='append', metavar='NAME=VALUE',
+                        help='setting for the runner, e.g. UPLOAD_MODE=write_behind (repeatable)')
+    parser.add_argument('--keep-rate-limits', action='store_true',
+                        help='keep the rate limits of the runners instead of lifting them')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--timeout', type=float, default=6 * 3600, help='seconds a single run may take')
+    parser.add_argument('--keep-scratch', action='store_true', help='keep the database and logs of every run')
+    parser.add_argument('--output', help='JSON file for the results. Defaults to results/<timestamp>.json')
+    args = parser.parse_args()
+
+    latencies = parse_settings(args.latency)
+    error_rates = parse_settings(args.error_rate)
+    profiles = {provider: Profile(latencies.get(provider, 0), error_rates.get(provider, 0)) for provider in PROVIDERS}
+
+    print(f'{"runner":<10} {"records":>8} {"issued":>8} {"records/s":>10} {"wall (s)":>9} {"peak MB":>8}')
+    results = []
+    for runner in args.runners:
+        for size in args.sizes:
+            result = run_one(runner, size, args, profiles)
+            print_result(result)
+            results.append(result)
+
+    output = args.output or os.path.join(BENCH_DIR, 'results', f'{datetime.datetime.utcnow():%Y-%m-%dT%H-%M-%S}.json')
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({'settings': {'latency': latencies, 'error_rate': error_rates, 'pdf_size': args.pdf_size,
+                                'env': args.env or [], 'keep_rate_limits': args.keep_rate_limits, 'seed': args.seed},
+                   'results': results}, f, indent=2)
+    print(f'\nResults saved to {output}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Stand-in for the hubapi module the runners import, which is not part of this repository. It has
+the same functions, talking to the Hubspot stand-in of fake_providers.py at HUBSPOT_API_URL.
+run_benchmarks.py puts this folder in front of the package on the path of the runner.
+"""
+
+import logging
+import os
+
+import requests
+
+logger = logging.getLogger(F'LinkedInAssignDueDateUpdate.{__name__}')
+
+HUBSPOT_API_URL = os.getenv('HUBSPOT_API_URL', 'http://127.0.0.1:8090')
+BATCH_SIZE = 100 # Most inputs Hubspot takes in one batch request
+
+_session = requests.Session()
+_session.headers.update({'Authorization': f'Bearer {os.getenv("HS_TOKEN", "benchmark")}',
+                         'Content-Type': 'application/json'})
+
+
+def _checked(res):
+    res.raise_for_status()
+    return res
+
+
+def search_records(object_type, payload):
+    """One page of a search, as a response"""
+    return _checked(_session.post(f'{HUBSPOT_API_URL}/crm/v3/objects/{object_type}/search', json=payload, timeout=30))
+
+
+def search_all_records(object_type, payload):
+    """Every page of a search, as a list of records"""
+    payload = dict(payload)
+    results = []
+    while True:
+        data = search_records(object_type, payload).json()
+        results.extend(data['results'])
+        after = data.get('paging', {}).get('next', {}).get('after')
+        if not after:
+            return results
+        payload['after'] = after
+
+
+def get_all_records(object_type, add_params=None):
+    """Every record of an object, as a list of records"""
+    params = {'limit': 100}
+    for name, value in (add_params or {}).items():
+        params[name] = ','.join(sorted(value)) if isinstance(value, (set, list, tuple)) else value
+    results = []
+    while True:
+        data = _checked(_session.get(f'{HUBSPOT_API_URL}/crm/v3/objects/{object_type}', params=params, timeout=30)).json()
+        results.extend(data['results'])
+        after = data.get('paging', {}).get('next', {}).get('after')
+        if not after:
+            return results
+        params['after'] = after
+
+
+class UpdateRecordsHandler:
+    def __init__(self, object_type):
+        """Batch updates of the records of an object"""
+        self.object_type = object_type
+
+    def dispatch(self, payload):
+        """Update the records of a payload, BATCH_SIZE at a time"""
+        inputs = payload.get('inputs', [])
+        for start in range(0, len(inputs), BATCH_SIZE):
+            logger.info(f'Working on batch request {start // BATCH_SIZE + 1}/{(len(inputs) - 1) // BATCH_SIZE + 1}...')
+            _checked(_session.post(f'{HUBSPOT_API_URL}/crm/v3/objects/{self.object_type}/batch/update',
+                                   json={'inputs': inputs[start:start + BATCH_SIZE]}, timeout=30))